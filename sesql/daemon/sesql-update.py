@@ -65,6 +65,13 @@ class UpdateDaemon(UnixDaemon):
             self.log.debug("Sleeping for %.2f second(s)" % self.delay)
             time.sleep(self.delay)
 
+    def unschedule(self, cursor, row):
+        """
+        Remove a processed row from the schedule
+        """
+        cursor.execute("""DELETE FROM sesql_reindex_schedule
+                          WHERE classname=%s AND objid=%s""", row)
+
     @transaction.commit_manually
     def process_chunk(self):
         """
@@ -81,26 +88,46 @@ class UpdateDaemon(UnixDaemon):
         self.log.info("Found %d row(s) to reindex" % len(rows))
 
         done = set()
+        objs = []
 
         for row in rows:
             try:
                 row = tuple(row)
                 if not row in done:
-                    self.log.info("Reindexing %s:%d" % row)
                     done.add(row)
                     try:
-                        obj = results.SeSQLResultSet.load(row)
-                        index.index(obj)
+                        objs.append((row, results.SeSQLResultSet.load(row)))
                     except config.orm.not_found:
                         self.log.info("%s:%d doesn't exist anymore, undexing" % row)
                         index.unindex(row)
-                    cursor.execute("""DELETE FROM sesql_reindex_schedule
-                                      WHERE classname=%s AND objid=%s""", row)
+                        self.unschedule(cursor, row)
             except Exception, e:
                 self.log.error('Error in row %s:%s : %s' % (row[0], row[1], e))
                 if cmd["debug"]:
                     import pdb
                     pdb.post_mortem()
+
+        if not objs:
+            transaction.commit()
+            return
+
+        try:
+            self.log.info("Reindexing %d object(s)" % len(objs))
+            index.index_many([ obj for row, obj in objs ])
+            for row, obj in objs:
+                self.unschedule(cursor, row)
+        except Exception, e:
+            self.log.error('Error in batch reindexing, falling back to one by one : %s' % e)
+            for row, obj in objs:
+                try:
+                    self.log.info("Reindexing %s:%d" % row)
+                    index.index(obj)
+                    self.unschedule(cursor, row)
+                except Exception, e:
+                    self.log.error('Error in row %s:%s : %s' % (row[0], row[1], e))
+                    if cmd["debug"]:
+                        import pdb
+                        pdb.post_mortem()
         transaction.commit()
 
 if __name__ == "__main__":
@@ -62,7 +62,11 @@ def create_master_table():
     Create the master table, that is, the one from which the others
     will inherit
     """
-    schema = "\n  ".join([ field.schema() for field in config.FIELDS ])
+    schema = [ field.schema() for field in config.FIELDS ]
+    hash_column = getattr(config, 'INDEX_CONTENT_HASH', None)
+    if hash_column:
+        schema.append("%s char(40)," % hash_column)
+    schema = "\n  ".join(schema)
 
     return [
         "DROP TABLE IF EXISTS %s CASCADE" % config.MASTER_TABLE_NAME,
@@ -85,7 +89,9 @@ def create_table(table = None):
     res = [ "CREATE TABLE %s (CHECK (%s), PRIMARY KEY (classname, id)) INHERITS (%s)" % (table, condition, config.MASTER_TABLE_NAME) ]
 
     for field in config.FIELDS:
-        res.append(field.index(table))
+        index = field.index(table)
+        if index:
+            res.append(index)
 
     for cross in config.CROSS_INDEXES:
         res.append("CREATE INDEX %s_%s_index ON %s (%s);" % (table, "_".join(cross), table, ",".join(cross)))
@@ -113,14 +119,69 @@ def create_schedule_table():
         "CREATE INDEX sesql_reindex_schedule_content_index ON sesql_reindex_schedule (classname, rowid)"
     ]
 
+@sql_function
+def create_query_cache_table():
+    """
+    Create the table used by the shared query cache
+    """
+    from sesql.querycache import PgQueryCache
+    table = PgQueryCache.TABLE_NAME
+    return [
+        "DROP TABLE IF EXISTS %s" % table,
+        """CREATE UNLOGGED TABLE %s (
+        queryid character varying(32) NOT NULL,
+        data bytea NOT NULL,
+        expires_at timestamp NOT NULL,
+        PRIMARY KEY (queryid)
+        )""" % table,
+        "CREATE INDEX %s_expires_at_index ON %s (expires_at)" % (table, table),
+    ]
+
+@sql_function
+def create_term_stats_table():
+    """
+    Create the table storing the term statistics
+    """
+    from sesql.termstats import TABLE_NAME
+    return [
+        "DROP TABLE IF EXISTS %s" % TABLE_NAME,
+        """CREATE TABLE %s (
+        tablename character varying(255) NOT NULL,
+        field character varying(255) NOT NULL,
+        word text NOT NULL,
+        ndoc integer NOT NULL,
+        PRIMARY KEY (tablename, field, word)
+        )""" % TABLE_NAME,
+    ]
+
+
+def check_generated_columns(cursor):
+    """
+    Ensure the tsvector columns which should be generated by PostgreSQL
+    are, since tables created without FULLTEXT_GENERATED_TSV would get
+    NULL tsvectors
+    """
+    columns = [ field.index_column for field in config.FIELDS
+                if getattr(field, "generated", False) ]
+    if not columns:
+        return
+    cursor.execute("""SELECT attname FROM pg_attribute
+WHERE attrelid = %%s::regclass AND attgenerated = '' AND attname IN (%s)""" %
+                   ','.join([ "%s" ] * len(columns)),
+                   [ config.MASTER_TABLE_NAME ] + columns)
+    plain = [ row[0] for row in cursor.fetchall() ]
+    if plain:
+        raise ValueError, "FULLTEXT_GENERATED_TSV is set, but columns %s of %s are not generated : the tables must be rebuilt" % (', '.join(plain), config.MASTER_TABLE_NAME)
 
 @config.orm.transactional
 def sync_db(cursor, verbosity = 0):
     if not config.orm.table_exists(cursor, config.MASTER_TABLE_NAME):
         create_dictionnary(cursor, execute = True, verbosity = verbosity, include_drop = True)
         create_master_table(cursor, execute = True, verbosity = verbosity, include_drop = True)
-    elif verbosity:
-        print "SeSQL : Table %s already existed, skipped." % config.MASTER_TABLE_NAME
+    else:
+        check_generated_columns(cursor)
+        if verbosity:
+            print "SeSQL : Table %s already existed, skipped." % config.MASTER_TABLE_NAME
 
     for table in typemap.all_tables():
         if not config.orm.table_exists(cursor, table):
@@ -132,3 +193,15 @@ def sync_db(cursor, verbosity = 0):
         create_schedule_table(cursor, execute = True, verbosity = verbosity, include_drop = True)
     elif verbosity:
         print "SeSQL : Table %s already existed, skipped." % 'sesql_reindex_schedule'
+
+    if getattr(config, 'QUERY_CACHE_BACKEND', 'local') == 'postgresql':
+        if not config.orm.table_exists(cursor, "sesql_query_cache"):
+            create_query_cache_table(cursor, execute = True, verbosity = verbosity, include_drop = True)
+        elif verbosity:
+            print "SeSQL : Table %s already existed, skipped." % 'sesql_query_cache'
+
+    if getattr(config, 'TERM_STATS', False):
+        if not config.orm.table_exists(cursor, "sesql_term_stats"):
+            create_term_stats_table(cursor, execute = True, verbosity = verbosity, include_drop = True)
+        elif verbosity:
+            print "SeSQL : Table %s already existed, skipped." % 'sesql_term_stats'
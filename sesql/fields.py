@@ -21,9 +21,9 @@ Contain the field types for SeSQL
 We cannot reuse Django types because what we need is too specific
 """
 import logging
-import unicodedata
+import json
 
-from sesql.utils import strip_ligatures
+from sesql.utils import get_normalize_table
 from sesql.sources import guess_source, ClassSource
 
 
@@ -84,6 +84,12 @@ class Field(object):
             return value.encode(config.CHARSET, 'ignore')
         return str(value)
 
+    def get_columns(self, method):
+        """
+        Get the columns used by the pattern of this operator
+        """
+        return [ self.index_column ]
+
     def get_default(self, value):
         """
         Get the default pattern
@@ -193,6 +199,46 @@ class StrField(Field):
         self.size = size
         self.sqltype = "varchar(%d)" % size
 
+class StoredField(Field):
+    """
+    This is a text field only stored in the index, to be fetched in
+    brains, but not searchable and not indexed
+    """
+    sqltype = "text"
+
+    def index(self, tablename):
+        """
+        Stored fields have no index
+        """
+        return None
+
+    def get_default(self, value):
+        """
+        Get the default pattern
+        """
+        raise ValueError, " = not supported for %s" % self.__class__.__name__
+
+    def get_in(self, value):
+        """
+        Get the pattern for __in operator
+        """
+        raise ValueError, " __in = not supported for %s" % self.__class__.__name__
+
+class JSONField(StoredField):
+    """
+    This is a stored field holding any JSON-serializable value
+    Values are decoded by psycopg2 when fetched
+    """
+    sqltype = "jsonb"
+
+    def marshall(self, value):
+        """
+        Marshall the value to JSON
+        """
+        if value is None:
+            return None
+        return json.dumps(value)
+
 class ClassField(Field):
     """
     This is a field storing the class of the object
@@ -336,6 +382,17 @@ class FullTextField(Field):
 
     dictionnary = property(get_dictionnary, set_dictionnary)
 
+    @property
+    def generated(self):
+        """
+        Is the tsvector column generated by PostgreSQL from the text column ?
+        Only unweighted fields can be, with FULLTEXT_GENERATED_TSV enabled
+        """
+        from sesql import config
+        if hasattr(self.source, "weights"):
+            return False
+        return getattr(config, 'FULLTEXT_GENERATED_TSV', False)
+
     def marshall(self, value, extra_letters = "", use_cleanup = True):
         """
         Strip accents, escape html_entities, handle unicode, ...
@@ -358,24 +415,20 @@ class FullTextField(Field):
             except UnicodeDecodeError:
                 raise ValueError, "Can't parse %s in %s" % (value, config.CHARSET)
 
-        # Remove ligatures (oe, ae, ...)
-        value = strip_ligatures(value)
-
-        # Replace non-standard character by spaces
-        def isletter(c):
-            category = unicodedata.category(c)[0]
-            return category in ('L', 'N') or c in extra_letters
-        value = u''.join([ isletter(c) and c or u' ' for c in value ])
-
-        # Now strip accents
-        value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
-        value = value.lower()
-        return value
+        # Remove ligatures (oe, ae, ...), replace non-standard
+        # characters by spaces, strip accents and lowercase
+        value = value.translate(get_normalize_table(extra_letters))
+        return value.encode('ascii')
 
     def schema(self):
         """
         Get the field definition
         """
+        if self.generated:
+            return """%s text,
+  %s tsvector GENERATED ALWAYS AS (to_tsvector('%s', %s)) STORED,""" % (
+                self.data_column, self.index_column, self.dictionnary,
+                self.data_column)
         return """%s text,
   %s tsvector,""" % (self.data_column, self.index_column)
 
@@ -389,6 +442,16 @@ ALTER TABLE %s ALTER COLUMN %s SET STATISTICS 1000;""" % (tablename,
                                                            self.index_column)
         return value
 
+    def get_columns(self, method):
+        """
+        Get the columns used by the pattern of this operator
+        """
+        if method == "like":
+            return [ self.data_column ]
+        if method == "containsexact":
+            return [ self.index_column, self.data_column ]
+        return [ self.index_column ]
+
     def get_default(self, value):
         """
         Get the default pattern
@@ -401,49 +464,75 @@ ALTER TABLE %s ALTER COLUMN %s SET STATISTICS 1000;""" % (tablename,
         """
         raise ValueError, " __in = not supported for FullTextField"
 
-    def pattern_contains(self, value):
+    def pattern_contains(self, value, memo = None):
         """
         Get the pattern for __contains* operators, in raw mode
         (return indexname, operator, value)
+        If memo is given, the result is kept in it, so a query only
+        marshalls each value once
         """
+        key = (self.name, "contains", value)
+        if memo is not None and key in memo:
+            column, pattern, values = memo[key]
+            return column, pattern, list(values)
+
         pattern = "plainto_tsquery('%s', %%s)" % self.dictionnary
         values = [ self.marshall(value) ]
 
+        if memo is not None:
+            memo[key] = (self.index_column, pattern, values)
         return self.index_column, pattern, values
 
-    def pattern_matches(self, value):
+    def pattern_matches(self, value, memo = None):
         """
         Get the pattern for __matches operator, in raw mode
         (return indexname, operator, value)
         """
+        key = (self.name, "matches", value)
+        if memo is not None and key in memo:
+            column, pattern, values = memo[key]
+            return column, pattern, list(values)
+
         pattern = "to_tsquery('%s', %%s)" % self.dictionnary
         values = [ self.marshall(value, extra_letters = '&|!()') ]
 
+        if memo is not None:
+            memo[key] = (self.index_column, pattern, values)
         return self.index_column, pattern, values
 
-    def get_containswords(self, value):
+    def get_containswords(self, value, share = None, memo = None):
         """
         Get the pattern for __containswords operator
+        If share is given, it is called with the tsquery pattern and
+        values, and gives the expression to use instead
         """
-        column, pattern, values = self.pattern_contains(value)
+        column, pattern, values = self.pattern_contains(value, memo)
+        if share:
+            pattern, values = share(pattern, values), []
         pattern = "%s @@ %s" % (column, pattern)
         return pattern, values
 
-    def get_containsexact(self, value):
+    def get_containsexact(self, value, share = None, memo = None):
         """
         Get the pattern for __containsexact operator - can be slow.
         """
-        pattern, values = self.get_containswords(value)
-        pattern = "(%s AND %s)" % (pattern, "%s LIKE %%s" % self.data_column)
-        values = [ values[0], '%' + values[0]  + '%' ]
+        column, pattern, values = self.pattern_contains(value, memo)
+        text = values[0]
+        if share:
+            pattern, values = share(pattern, values), []
+        pattern = "(%s @@ %s AND %s LIKE %%s)" % (column, pattern,
+                                                 self.data_column)
+        values = values + [ '%' + text  + '%' ]
 
         return pattern, values
 
-    def get_matches(self, value):
+    def get_matches(self, value, share = None, memo = None):
         """
         Get the pattern for __matches operator (PostgreSQL tsquery string)
         """
-        column, pattern, values = self.pattern_matches(value)
+        column, pattern, values = self.pattern_matches(value, memo)
+        if share:
+            pattern, values = share(pattern, values), []
         pattern = "%s @@ %s" % (column, pattern)
         return pattern, values
 
@@ -455,30 +544,32 @@ ALTER TABLE %s ALTER COLUMN %s SET STATISTICS 1000;""" % (tablename,
         values = [ self.marshall(value, extra_letters = '%') ]
         return pattern, values
 
-    def rank_containswords(self, value):
+    def rank_containswords(self, value, memo = None):
         """
         Get the ranking pattern for __containswords operator
         """
-        return self.pattern_contains(value)
+        return self.pattern_contains(value, memo)
 
-    def rank_containsexact(self, value):
+    def rank_containsexact(self, value, memo = None):
         """
         Get the ranking pattern for __containsexact operator - can be slow.
         """
         log.warning("Ranking on exact will fall back to ranking on contains")
-        return self.rank_containswords(value)
+        return self.rank_containswords(value, memo)
 
-    def rank_matches(self, value):
+    def rank_matches(self, value, memo = None):
         """
         Get the ranking pattern for __matches operator
         """
-        return self.pattern_matches(value)
+        return self.pattern_matches(value, memo)
 
     @property
     def index_columns(self):
         """
         Get the columns to populate at indexation time
         """
+        if self.generated:
+            return [ self.data_column ]
         return [ self.data_column, self.index_column ]
 
     @property
@@ -486,6 +577,8 @@ ALTER TABLE %s ALTER COLUMN %s SET STATISTICS 1000;""" % (tablename,
         """
         Get the placeholders to use at indexation time
         """
+        if self.generated:
+            return [ self.placeholder ]
         if hasattr(self.source, "weights"):
             weights = self.source.weights
             vals = []
@@ -500,12 +593,13 @@ ALTER TABLE %s ALTER COLUMN %s SET STATISTICS 1000;""" % (tablename,
         """
         Get values for the object
         """
-        vals = [ self.marshall(self.source.load_data(obj)) ]
+        text = self.marshall(self.source.load_data(obj))
+        vals = [ text ]
         if hasattr(self.source, "weights"):
             weights = self.source.weights
             for weight in weights:
                 vals.append(self.marshall(self.source.load_data(obj, weight)))
-        else:
-            vals.append(self.marshall(self.source.load_data(obj)))
+        elif not self.generated:
+            vals.append(text)
         return vals
 
@@ -16,12 +16,18 @@
 
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+# Allow "with" with python2.5
+from __future__ import with_statement
+
+import hashlib
 import logging
 
 from sesql import utils
+from sesql import sources
 from sesql import config
 from sesql import typemap
 from sesql import fieldmap
+from sesql import resultcache
 
 log = logging.getLogger('sesql')
 
@@ -47,13 +53,81 @@ def get_values(obj, fields):
     placeholders = [ ]
     results = [ ]
 
-    for field in fields:
-        keys.extend(field.index_columns)
-        placeholders.extend(field.index_placeholders)
-        results.extend(field.get_values(obj))
+    # Sources shared by several fields are only evaluated once
+    with sources.SourceMemo(obj):
+        for field in fields:
+            keys.extend(field.index_columns)
+            placeholders.extend(field.index_placeholders)
+            results.extend(field.get_values(obj))
 
     return keys, placeholders, results
 
+def get_insert_query(table_name, keys, placeholders, nbrows = 1):
+    """
+    Get the INSERT query for nbrows rows of the given keys into a table
+    In INDEX_UPSERT mode, existing rows will be updated in place
+    """
+    row = "(%s)" % ",".join(placeholders)
+    query = "INSERT INTO %s (%s) VALUES %s" % (table_name, ",".join(keys),
+                                               ",".join([ row ] * nbrows))
+    if getattr(config, 'INDEX_UPSERT', False):
+        # Every indexed column is set, like with DELETE and INSERT, so
+        # columns not given this time don't keep stale values
+        updates = []
+        for column in get_indexed_columns():
+            if column in ('classname', 'id'):
+                continue
+            if column in keys:
+                updates.append("%s=EXCLUDED.%s" % (column, column))
+            else:
+                updates.append("%s=NULL" % column)
+        query += " ON CONFLICT (classname, id) DO UPDATE SET %s" % ",".join(updates)
+    return query
+
+def get_indexed_columns():
+    """
+    Get all the columns filled at indexation time
+    """
+    columns = []
+    for field in config.FIELDS:
+        columns.extend(field.index_columns)
+    hash_column = getattr(config, 'INDEX_CONTENT_HASH', None)
+    if hash_column:
+        columns.append(hash_column)
+    return columns
+
+def delete_entries(cursor, table_name, items):
+    """
+    Delete the (classname, id) entries from the table
+    """
+    if not items:
+        return
+    ids = []
+    for item in items:
+        ids.extend(item[:2])
+    query = "DELETE FROM %s WHERE (classname, id) IN (%s)" % (
+        table_name, ",".join([ "(%s,%s)" ] * len(items)))
+    cursor.execute(query, ids)
+
+def get_digest(results):
+    """
+    Get a digest of the marshalled values of an object
+    """
+    return hashlib.sha1(repr(results)).hexdigest()
+
+def get_hashes(cursor, table_name, items):
+    """
+    Get the content hash currently stored for those (classname, id) entries
+    """
+    hash_column = config.INDEX_CONTENT_HASH
+    ids = []
+    for item in items:
+        ids.extend(item)
+    query = "SELECT classname, id, %s FROM %s WHERE (classname, id) IN (%s)" % (
+        hash_column, table_name, ",".join([ "(%s,%s)" ] * len(items)))
+    cursor.execute(query, ids)
+    return dict([ ((row[0], row[1]), row[2]) for row in cursor.fetchall() ])
+
 def get_sesql_id(obj):
     """
     Get classname and id, the SeSQL identifiers
@@ -113,26 +187,128 @@ def index(cursor, obj, message, noindex = False, index_related = True):
         log.info("%s: no table found, skipping" % message)
         return
 
-    query = "DELETE FROM %s WHERE id=%%s AND classname=%%s" % table_name
-    cursor.execute(query, (objid, classname))
+    skip = not noindex and config.SKIP_CONDITION and config.SKIP_CONDITION(obj)
 
-    if noindex:
-        log.info("%s : running in 'noindex' mode, only deleteing" % message)
+    if noindex or skip:
+        delete_entries(cursor, table_name, [ (classname, objid) ])
+        resultcache.bump(table_name)
+        if noindex:
+            log.info("%s : running in 'noindex' mode, only deleteing" % message)
+        else:
+            log.info("%s : not indexing because of skip_condition" % message)
         return
 
-    if config.SKIP_CONDITION and config.SKIP_CONDITION(obj):
-        log.info("%s : not indexing because of skip_condition" % message)
-        return
+    keys, placeholders, results = get_values(obj, config.FIELDS)
 
-    log.info("%s : indexing entry in table %s" % (message, table_name))
+    hash_column = getattr(config, 'INDEX_CONTENT_HASH', None)
+    if hash_column:
+        digest = get_digest(results)
+        hashes = get_hashes(cursor, table_name, [ (classname, objid) ])
+        if hashes.get((classname, objid)) == digest:
+            log.info("%s : content unchanged, skipping" % message)
+            return
+        keys, placeholders, results = (keys + [ hash_column ],
+                                       placeholders + [ "%s" ],
+                                       results + [ digest ])
+
+    # In upsert mode, the INSERT will replace the existing entry
+    if not getattr(config, 'INDEX_UPSERT', False):
+        delete_entries(cursor, table_name, [ (classname, objid) ])
 
-    keys, placeholders, results = get_values(obj, config.FIELDS)
+    log.info("%s : indexing entry in table %s" % (message, table_name))
 
-    query = "INSERT INTO %s (%s) VALUES (%s)" % (table_name,
-                                                 ",".join(keys),
-                                                 ",".join(placeholders))
+    query = get_insert_query(table_name, keys, placeholders)
     cursor.execute(query, results)
+    resultcache.bump(table_name)
 
+@config.orm.transactional_once
+def index_many(cursor, objs, index_related = True):
+    """
+    Index several objects into SeSQL at once
+
+    Objects are grouped by table, and each table is handled by chunks
+    of INDEX_BATCH_SIZE objects, with one DELETE and one multi-rows
+    INSERT (or upsert) per chunk
+    """
+    tables = {}
+    done = set()
+
+    for obj in objs:
+        try:
+            classname, objid = get_sesql_id(obj)
+        except (TypeError, AttributeError, ValueError):
+            log.info("%r: can't get classname/id, skipping" % obj)
+            continue
+
+        if (classname, objid) in done:
+            continue
+        done.add((classname, objid))
+
+        # Handle dependancies
+        gro = getattr(obj, "get_related_objects_for_indexation", None)
+        if index_related and gro:
+            for item in gro():
+                schedule_reindex(item)
+
+        table_name = typemap.typemap.get_table_for(classname)
+        if not table_name:
+            log.info("%s:%s: no table found, skipping" % (classname, objid))
+            continue
+        tables.setdefault(table_name, []).append((classname, objid, obj))
+
+    step = getattr(config, 'INDEX_BATCH_SIZE', 100)
+    upsert = getattr(config, 'INDEX_UPSERT', False)
+    hash_column = getattr(config, 'INDEX_CONTENT_HASH', None)
+
+    for table_name, items in tables.items():
+        log.info("index_many : indexing %d entries in table %s" % (len(items),
+                                                                  table_name))
+        for start in range(0, len(items), step):
+            chunk = items[start:start + step]
+
+            skipped = []
+            if config.SKIP_CONDITION:
+                skipped = [ item for item in chunk
+                            if config.SKIP_CONDITION(item[2]) ]
+                chunk = [ item for item in chunk if item not in skipped ]
+
+            rows = []
+            objs = [ item[2] for item in chunk ]
+            with sources.SourcePrefetch(objs, [ field.source for field in config.FIELDS ]):
+                for classname, objid, obj in chunk:
+                    keys, placeholders, values = get_values(obj, config.FIELDS)
+                    rows.append(((classname, objid), values))
+
+            if hash_column and rows:
+                hashes = get_hashes(cursor, table_name, [ row[0] for row in rows ])
+                changed = []
+                for item, values in rows:
+                    digest = get_digest(values)
+                    if hashes.get(item) != digest:
+                        changed.append((item, values + [ digest ]))
+                log.info("index_many : %d unchanged entries in table %s" % (
+                    len(rows) - len(changed), table_name))
+                rows = changed
+                keys, placeholders = keys + [ hash_column ], placeholders + [ "%s" ]
+
+            # In upsert mode, only the skipped entries have to be deleted
+            if upsert:
+                delete_entries(cursor, table_name, skipped)
+            else:
+                delete_entries(cursor, table_name,
+                               skipped + [ row[0] for row in rows ])
+
+            if not rows:
+                continue
+
+            results = []
+            for item, values in rows:
+                results.extend(values)
+
+            query = get_insert_query(table_name, keys, placeholders, len(rows))
+            cursor.execute(query, results)
+
+        resultcache.bump(table_name)
 
 @index_log_wrap
 def unindex(obj, message):
@@ -163,10 +339,16 @@ def update(cursor, obj, message, fields):
         log.info("%s : nothing to update, skipping" % message)
         return
 
+    # The stored hash no longer matches the whole content
+    hash_column = getattr(config, 'INDEX_CONTENT_HASH', None)
+    if hash_column:
+        pattern.append('%s=NULL' % hash_column)
+
     pattern = ",".join(pattern)
 
     query = "UPDATE %s SET %s WHERE classname=%%s AND id=%%s" % (table_name,
                                                                  pattern)
     cursor.execute(query, results + [ obj.__class__.__name__, obj.id ])
+    resultcache.bump(table_name)
 
 
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+from sesql.utils import log_time
+from sesql.query import SeSQLQuery
+
+@log_time
+def keysetquery(query, order=None, limit=50, after=None, fields = ()):
+    """
+    Perform a keyset query and return a lazy Django result set
+
+    after is the sort key of the last row of the previous page, as
+    given by the next_key attribute of its result set, or None for the
+    first page
+
+    If fields are specified, will fetch those fields from the index
+    """
+    query = SeSQLQuery(query, order, fields)
+    return query.keysetquery(limit, after)
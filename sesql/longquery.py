@@ -18,21 +18,23 @@
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
 
 import string, random
-from GenericCache import GenericCache
 
 from sesql import config
 from sesql import utils
 from sesql.query import SeSQLQuery
+from sesql.querycache import get_query_cache
 
 import logging
 log = logging.getLogger('sesql')
 
-_query_cache = GenericCache(maxsize = config.QUERY_CACHE_MAX_SIZE,
-                            expiry = config.QUERY_CACHE_EXPIRY)
+_query_cache = get_query_cache()
+
+# Concurrent identical long queries
+_flights = utils.SingleFlight()
 
 @utils.log_time
 def longquery(query, order=None, limit=None, queryid=None, historize=False,
-              fields = ()):
+              fields = (), stream = False, withhold = False):
     """
     Perform a long query and return a lazy Django result set
 
@@ -41,36 +43,51 @@ def longquery(query, order=None, limit=None, queryid=None, historize=False,
     redone, results may have changed.
 
     If fields are specified, will fetch those fields from the index
+
+    If stream is set, rows will be fetched by batches from a server-side
+    cursor as the result set is used, and the results won't be cached
+    (see SeSQLQuery.longquery)
     """
+    if stream:
+        query = SeSQLQuery(query, order, fields)
+        results = query.longquery(limit, stream = True, withhold = withhold)
+        if historize: # suggest feature hook
+            results.historize(query)
+        return results
+
     if queryid:
-        _query_cache.lock.acquire()
-        try:
-            results = _query_cache[queryid]
-            if results:
-                return results
-            log.warning('Cached query id %r expired, re-querying.' % queryid)
-        finally:
-            _query_cache.lock.release()
+        results = _query_cache.get(queryid)
+        if results is not None:
+            results.queryid = queryid
+            return results
+        log.warning('Cached query id %r expired, re-querying.' % queryid)
 
     query = SeSQLQuery(query, order, fields)
-    results = query.longquery(limit)
-
-    _query_cache.lock.acquire()
-    try:
-        # Generate a new query id, ensuring it's unique
-        if not queryid:
-            while True:
-                letters = string.ascii_letters + string.digits
-                queryid = ''.join([ random.choice(letters) for i in range(32) ])
-                if queryid not in _query_cache:
-                    break
-        _query_cache[queryid] = results
-        results.queryid = queryid
-    finally:
-        _query_cache.lock.release()
+    if getattr(config, 'COALESCE_QUERIES', False):
+        # Concurrent identical queries share the results and queryid
+        results = _flights.do((query.get_cache_key(limit), queryid),
+                              do_longquery, query, limit, queryid)
+    else:
+        results = do_longquery(query, limit, queryid)
 
     if historize: # suggest feature hook
         results.historize(query)
 
     return results
 
+def do_longquery(query, limit, queryid):
+    """
+    Perform the long query, and store the results in the cache
+    """
+    results = query.longquery(limit)
+
+    # Generate a new query id, ensuring it's unique
+    if not queryid:
+        while True:
+            letters = string.ascii_letters + string.digits
+            queryid = ''.join([ random.choice(letters) for i in range(32) ])
+            if queryid not in _query_cache:
+                break
+    _query_cache.set(queryid, results)
+    results.queryid = queryid
+    return results
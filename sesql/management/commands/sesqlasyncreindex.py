@@ -111,13 +111,22 @@ class Command(BaseCommand):
         cursor.execute(query, vals)
         self.switch_to_new()
         nb = 0
+        objs = []
         for item in cursor:
             if self.options['verbose']:
                 print "Indexing %s" % (item,)
-            obj = results.SeSQLResultSet.load((item[0], item[1]))
-            index.index(obj, index_related = False)
+            objs.append(results.SeSQLResultSet.load((item[0], item[1])))
             last = item[2]
             nb += 1
+        try:
+            index.index_many(objs, index_related = False)
+        except Exception, e:
+            print "Error indexing chunk, falling back to one by one : %s" % e
+            for obj in objs:
+                try:
+                    index.index(obj, index_related = False)
+                except Exception, e:
+                    print "Error indexing %r : %s" % (obj, e)
         if nb:
             self.state['last'] = (item[0], item[1])
             self.state['since'] = last
@@ -23,19 +23,26 @@ on an existing database, or when you alter your indexes.
 # Allow "with" with python2.5
 from __future__ import with_statement
 
+import os
 import sys
+import cPickle
+import multiprocessing
+from Queue import Empty
 from optparse import make_option
 
 from django.core.management.base import BaseCommand
 from django.db import connection, transaction
+from django.db.models import Min, Max
 
 from sesql import config
-from sesql.index import index
+from sesql.index import index, index_many
 from sesql.utils import Timer
 from sesql.typemap import typemap
-from sesql.results import SeSQLResultSet
 
 STEP = 1000
+RANGES_PER_WORKER = 4
+# Seconds to wait for a worker message before checking they are alive
+WORKER_TIMEOUT = 10
 
 
 class Command(BaseCommand):
@@ -61,15 +68,214 @@ class Command(BaseCommand):
                     dest='order',
                     default=None,
                     help='Sort order of the content to process'),
+        make_option('-w', '--workers',
+                    dest='workers',
+                    default=1,
+                    type='int',
+                    help='Number of worker processes, each working on its own id ranges (default: 1)'),
+        make_option('--state',
+                    dest='state',
+                    default=None,
+                    help='Use given file as state file (allow graceful restart where it stopped)'),
         )
 
+    def get_missing_ids(self, klass, classname, reindex, start = None, end = None):
+        """
+        Get the queryset of ids to index for the class, optionally in
+        the [start, end[ id range
+
+        Missing objects are found by PostgreSQL, with an anti-join on
+        the SeSQL table
+        """
+        table = typemap.get_table_for(klass)
+        objs = klass.objects.all()
+        if start is not None:
+            objs = objs.filter(id__gte = start, id__lt = end)
+
+        if not reindex:
+            qn = connection.ops.quote_name
+            where = """NOT EXISTS (SELECT 1 FROM %s sesql
+                                   WHERE sesql.classname = %%s
+                                   AND sesql.id = %s.%s)""" % (table,
+                                                               qn(klass._meta.db_table),
+                                                               qn(klass._meta.pk.column))
+            objs = objs.extra(where = [ where ], params = [ classname ])
+
+        if start is not None:
+            objs = objs.order_by('id')
+        elif self.options["order"]:
+            objs = objs.order_by(self.options["order"])
+
+        return objs.values_list('id', flat = True)
+
+    def get_missing(self, klass, classname, reindex, count = True):
+        """
+        Get the number of objects, of already indexed objects, of
+        objects to index, and the queryset of ids to index for the class
+
+        Counting the objects to index runs the anti-join a second time,
+        so it is only done if count is set (else it is None)
+        """
+        table = typemap.get_table_for(klass)
+        cursor = connection.cursor()
+        cursor.execute("SELECT count(*) FROM %s WHERE classname=%%s" % table,
+                       (classname,))
+        nb_already = cursor.fetchone()[0]
+        nball = klass.objects.count()
+
+        ids = self.get_missing_ids(klass, classname, reindex)
+        if reindex:
+            nb_missing = nball
+        elif count:
+            nb_missing = ids.count()
+        else:
+            nb_missing = None
+
+        return nball, nb_already, nb_missing, ids
+
+    def stream_ids(self, ids):
+        """
+        Iterate over the ids of the queryset by chunks of STEP ids,
+        using a server-side cursor which survives the commits
+        """
+        query, params = ids.query.get_compiler(using = ids.db).as_sql()
+        cursor = config.orm.named_cursor('sesql_reindex', withhold = True)
+        try:
+            cursor.execute(query, params)
+            # Commit now so the cursor survives a rollback of the first chunk
+            transaction.commit()
+            while True:
+                rows = cursor.fetchmany(STEP)
+                if not rows:
+                    break
+                yield [ int(row[0]) for row in rows ]
+        finally:
+            cursor.close()
+
+    def index_ids(self, klass, classname, chunks, progress):
+        """
+        Index the given chunks of ids, calling progress with the last id
+        and the number of objects processed after each chunk
+        """
+        for chunk in chunks:
+            loaded = klass.objects.in_bulk(chunk)
+            objs = [ loaded[oid] for oid in chunk if oid in loaded ]
+            del loaded
+            try:
+                index_many(objs)
+                transaction.commit()
+            except Exception, e:
+                print "Error indexing chunk of %s, falling back to one by one : %s" % (classname, e)
+                transaction.rollback()
+                for obj in objs:
+                    try:
+                        index(obj)
+                        transaction.commit()
+                    except Exception, e:
+                        print "Error indexing (%s,%s) : %s" % (classname, obj.id, e)
+                        transaction.rollback()
+            del objs
+
+            progress(chunk[-1], len(chunk))
+
+    @transaction.commit_manually
+    def reindex_range(self, klass, classname, start, end, progress):
+        """
+        Reindex the [start, end[ id range of a class
+        """
+        try:
+            ids = self.get_missing_ids(klass, classname,
+                                       self.options['reindex'], start, end)
+            self.index_ids(klass, classname, self.stream_ids(ids), progress)
+        finally:
+            transaction.commit()
+        progress(end - 1, 0)
+
+    def worker(self, klass, classname, tasks, results):
+        """
+        Main loop of a worker process : reindex ranges from the task queue
+        """
+        # Never share the parent database connection
+        connection.close()
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                rangeid, start, end = task
+
+                def progress(lastid, count):
+                    results.put((rangeid, lastid + 1, count))
+
+                self.reindex_range(klass, classname, start, end, progress)
+        finally:
+            connection.close()
+            results.put(os.getpid())
+
+    def get_ranges(self, klass, classname):
+        """
+        Get the id ranges of the class, from the state if possible
+        Ranges are [ start, end, next id to process ] lists
+        """
+        ranges = self.state.get(classname)
+        if ranges is not None:
+            print "Resuming from state file %s" % self.options['state']
+            return ranges
+
+        bounds = klass.objects.aggregate(Min('id'), Max('id'))
+        idmin, idmax = bounds['id__min'], bounds['id__max']
+        if idmin is None:
+            return []
+        nbranges = self.options['workers'] * RANGES_PER_WORKER
+        width = (idmax - idmin) / nbranges + 1
+        ranges = []
+        for start in range(idmin, idmax + 1, width):
+            end = min(start + width, idmax + 1)
+            ranges.append([ start, end, start ])
+        return ranges
+
+    def save_state(self, classname, ranges):
+        """
+        Save the progress of the class into the state file, if any
+        """
+        if not self.options['state']:
+            return
+        self.state[classname] = ranges
+        cPickle.dump(self.state, open(self.options['state'], 'w'), 0)
+
+    def disp_stats(self, classname, done, nb):
+        """
+        Display the progress statistics
+        """
+        if nb == 0:
+            return
+
+        full_tmr = self.full_tmr
+        full_tmr.stop()
+        elapsed = full_tmr.get_global()
+        elapsed_last = full_tmr.peek()
+        step = done - self.last_done
+        self.last_done = done
+        print "**SeSQL reindex step stats**"
+        print " - %d objects in %.2f s, rate %.2f" % (step, elapsed_last, step / elapsed_last)
+        print "**SeSQL global reindex on %s stats**" % classname
+        if nb is None:
+            # Not counted
+            print " - %d in %.2f s, rate %.2f" % (done, elapsed, done / elapsed)
+        else:
+            ratio = float(done) / float(nb)
+            eta = elapsed / ratio * (1 - ratio)
+            print " - %d / %d ( %04.1f %% ) in %.2f s, rate %.2f, ETA %.2f s" % (done, nb, 100 * ratio, elapsed, done / elapsed, eta)
+        sys.stdout.flush()
+        full_tmr.start()
+
     @transaction.commit_manually
     def reindex(self, classname, reindex=False, flush=False, dry_run=False):
         """
         Reindex a single class
         """
         klass = typemap.get_class_by_name(classname)
-        if not hasattr(klass, "objects"):
+        if not hasattr(klass, "objects") or not typemap.get_table_for(klass):
             return
 
         print "=> Starting reindexing for %s" % classname
@@ -77,30 +283,25 @@ class Command(BaseCommand):
             print "Dry-run mode."
         sys.stdout.flush()
 
-        objs = klass.objects.values('id')
-        if self.options["order"]:
-            objs = objs.order_by(self.options["order"])
-        allids = [int(a['id']) for a in objs]
-
         cursor = connection.cursor()
 
         if flush:
             print "Flushing all already indexed objects for class %s" % classname
             cursor.execute("DELETE FROM %s WHERE classname=%%s" % config.MASTER_TABLE_NAME,
                        (classname,))
+            self.state.pop(classname, None)
 
-        cursor.execute("SELECT id FROM %s WHERE classname=%%s" % config.MASTER_TABLE_NAME,
-                       (classname,))
-        already = set([int(c[0]) for c in cursor])
+        count = dry_run or int(self.options.get('verbosity', 1)) > 1
+        nball, nb_already, nb, ids = self.get_missing(klass, classname, reindex,
+                                                      count)
 
-        if not reindex:
-            missing = [oid for oid in allids if not oid in already]
+        if nb is None:
+            print "%s : %d object(s), %d already indexed, reindexing the missing ones (count them with -v 2)" % (
+                classname, nball, nb_already)
         else:
-            missing = allids
-
-        print "%s : %d object(s), %d already indexed, reindexing %d" % (classname, len(allids),
-                                                                   len(already),
-                                                                   len(missing))
+            print "%s : %d object(s), %d already indexed, reindexing %d" % (classname, nball,
+                                                                       nb_already,
+                                                                       nb)
 
         if dry_run:
             print "Dry-run: don't proceed. Rollback."
@@ -109,41 +310,79 @@ class Command(BaseCommand):
 
         sys.stdout.flush()
 
-        nb = len(missing)
-        full_tmr = Timer()
-
-        def disp_stats():
-            if not nb:
-                return
-
-            full_tmr.stop()
-            elapsed = full_tmr.get_global()
-            elapsed_last = full_tmr.peek()
-            done = float(i + 1) / float(nb)
-            eta = elapsed / done * (1 - done)
-            print "**SeSQL reindex step stats**"
-            print " - %d objects in %.2f s, rate %.2f" % (STEP, elapsed_last, STEP / elapsed_last)
-            print "**SeSQL global reindex on %s stats**" % classname
-            print " - %d / %d ( %04.1f %% ) in %.2f s, rate %.2f, ETA %.2f s" % (i + 1, nb, 100 * done, elapsed, i / elapsed, eta)
-            sys.stdout.flush()
-            full_tmr.start()
-
-        for i, oid in enumerate(missing):
-            obj = None
-            try:
-                obj = SeSQLResultSet.load((classname, oid))
-                index(obj)
-                transaction.commit()
-            except Exception, e:
-                print "Error indexing (%s,%s) : %s" % (classname, oid, e)
-                transaction.rollback()
-            del obj
+        self.full_tmr = Timer()
+        self.last_done = 0
 
-            if i % STEP == STEP - 1:
-                disp_stats()
+        if self.options['workers'] <= 1 and not self.options['state']:
+            status = { 'done': 0 }
 
-        disp_stats()
+            def progress(lastid, count):
+                status['done'] += count
+                if count == STEP:
+                    self.disp_stats(classname, status['done'], nb)
+
+            self.index_ids(klass, classname, self.stream_ids(ids), progress)
+            self.disp_stats(classname, status['done'], nb)
+            transaction.commit()
+            return
+
+        # Workers must see the flush, and have their own connection
         transaction.commit()
+        ranges = self.get_ranges(klass, classname)
+        if ranges and not [ r for r in ranges if r[2] < r[1] ]:
+            print "%s : already reindexed according to state file %s, skipping" % (
+                classname, self.options['state'])
+            return
+        self.save_state(classname, ranges)
+        connection.close()
+
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        for rangeid, (start, end, nextid) in enumerate(ranges):
+            if nextid < end:
+                tasks.put((rangeid, nextid, end))
+
+        nb_workers = max(self.options['workers'], 1)
+        for i in range(nb_workers):
+            tasks.put(None)
+
+        processes = [ multiprocessing.Process(target = self.worker,
+                                              args = (klass, classname,
+                                                      tasks, results))
+                      for i in range(nb_workers) ]
+        for process in processes:
+            process.start()
+
+        done = 0
+        finished = set()
+        while len(finished) < len(processes):
+            try:
+                message = results.get(timeout = WORKER_TIMEOUT)
+            except Empty:
+                # A worker killed (by a signal, the OOM killer, ...) never
+                # tells it finished
+                for process in processes:
+                    if not process.is_alive() and not process.pid in finished:
+                        print "Worker %d died with exit code %s, its current range is left unfinished" % (process.pid,
+                                                                                                        process.exitcode)
+                        finished.add(process.pid)
+                continue
+            if not isinstance(message, tuple):
+                finished.add(message)
+                continue
+            rangeid, nextid, count = message
+            ranges[rangeid][2] = nextid
+            self.save_state(classname, ranges)
+            done += count
+            if done - self.last_done >= STEP:
+                self.disp_stats(classname, done, nb)
+
+        for process in processes:
+            process.join()
+
+        if [ r for r in ranges if r[2] < r[1] ]:
+            self.unfinished = True
+        self.disp_stats(classname, done, nb)
 
     def handle(self, *classes, **options):
         """
@@ -151,9 +390,18 @@ class Command(BaseCommand):
         """
         self.options = options
 
+        if options['order'] and (options['workers'] > 1 or options['state']):
+            print "--order can't be used with --workers or --state"
+            sys.exit(1)
+
+        self.state = {}
+        if options['state'] and os.path.exists(options['state']):
+            self.state = cPickle.load(open(options['state']))
+
         if not classes:
             classes = typemap.all_class_names()
 
+        self.unfinished = False
         for klass in classes:
             self.reindex(
                 klass,
@@ -161,3 +409,9 @@ class Command(BaseCommand):
                 flush=options['flush'],
                 dry_run=options['dry_run']
             )
+
+        # A later run with the same state file must start over
+        if options['state'] and os.path.exists(options['state']) and \
+                not options['dry_run'] and not self.unfinished:
+            print "Reindexing complete, removing state file %s" % options['state']
+            os.remove(options['state'])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2011
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This will refresh the term statistics of the full text fields, used to
+estimate the selectivity of full text queries
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from sesql import config
+from sesql import termstats
+from sesql.typemap import typemap
+from sesql.fields import FullTextField
+
+
+class Command(BaseCommand):
+    help = "Refresh the term statistics of SeSQL full text fields"
+
+    option_list = BaseCommand.option_list + (
+        make_option('-t', '--table',
+                    dest='tables',
+                    action='append',
+                    default=[],
+                    help='Table to process (default: all)'),
+        make_option('-s', '--sample',
+                    dest='sample',
+                    type='float',
+                    default=None,
+                    help='Percentage of rows to sample (default: all rows)'),
+        )
+
+    def handle(self, **options):
+        """
+        Really handle the command
+        """
+        tables = options['tables'] or [ table for table in typemap.all_tables()
+                                         if table ]
+        fields = [ field for field in config.FIELDS
+                   if isinstance(field, FullTextField) ]
+
+        for table in tables:
+            for field in fields:
+                start_time = time.time()
+                termstats.refresh(table, field, options['sample'])
+                print "Refreshed %s on %s in %.2f s" % (field.name, table,
+                                                        time.time() - start_time)
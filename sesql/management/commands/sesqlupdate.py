@@ -54,7 +54,8 @@ class Command(BaseCommand):
         Reindex a single class
         """
         print "=> Starting reindexing columns %s." % ','.join(fields)
-        result = longquery(Q(classname__in = classnames))
+        result = longquery(Q(classname__in = classnames), stream = True,
+                           withhold = True)
         nb = len(result)
         print "=> We got %d objects." % nb
         sys.stdout.flush()
@@ -57,6 +57,13 @@ class AlchemyOrmAdapter(OrmAdapter):
         Load an object from its class and id
         """
         return self.source_maker().query(klass).filter_by(id = oid).one()
+
+    def load_objects(self, klass, ids):
+        """
+        Load at once the objects of a class from their ids
+        """
+        query = self.source_maker().query(klass).filter(klass.id.in_(ids))
+        return dict([ (obj.id, obj) for obj in query ])
         
     def historize(self, **kwargs):
         """
@@ -98,6 +105,13 @@ class AlchemyOrmAdapter(OrmAdapter):
         Get a cursor
         """
         return self.engine.raw_connection().cursor()
+
+    def named_cursor(self, name, withhold = False, scrollable = None):
+        """
+        Get a server-side (named) cursor
+        """
+        return self.engine.raw_connection().cursor(name, withhold = withhold,
+                                                   scrollable = scrollable)
         
     def begin(self):
         """
@@ -112,6 +126,8 @@ class AlchemyOrmAdapter(OrmAdapter):
         Commit sub-transaction on cursor
         """
         cursor.execute('COMMIT')
+        from sesql import resultcache
+        resultcache.committed()
 
     def rollback(self, cursor):
         """
@@ -17,10 +17,14 @@
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 from sesql.ormadapter import OrmAdapter
 from django.db import connection, transaction
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Q, OneToOneField, ManyToManyField
+
+log = logging.getLogger('sesql')
 
 class DjangoOrmAdapter(OrmAdapter):
     """
@@ -36,12 +40,107 @@ class DjangoOrmAdapter(OrmAdapter):
         """
         return connection.cursor()
 
+    def named_cursor(self, name, withhold = False, scrollable = None):
+        """
+        Give a server-side (named) cursor, fetching rows on demand
+        """
+        # Ensure the connection is opened
+        connection.cursor()
+        return connection.connection.cursor(name, withhold = withhold,
+                                            scrollable = scrollable)
+
+    def release_thread(self):
+        """
+        Called by helper threads once they are done with the database ;
+        the connection of the thread is closed, else each thread of the
+        pool would keep a backend busy for the life of the process
+        """
+        transaction.commit_unless_managed()
+        connection.close()
+
     def load_object(self, klass, oid):
         """
         Load an object from its class and id
         """
         return klass.objects.get(pk = oid)
+
+    def load_objects(self, klass, ids):
+        """
+        Load at once the objects of a class from their ids
+        """
+        return klass.objects.in_bulk(ids)
         
+    def prefetch_related(self, objs, name, condition = None):
+        """
+        Load at once the objects related to each of those objects (of
+        the same class) through the many-valued relation name, filtered
+        by condition
+        Relations which can't be prefetched give None, and are then
+        loaded object by object
+        """
+        try:
+            return self._prefetch_related(objs, name, condition)
+        except Exception, e:
+            log.warning("Can't prefetch %s of %s : %s" % (name, objs[0].__class__.__name__, e))
+            return None
+
+    def get_relation(self, model, name):
+        """
+        Get the relation of the model as (field, direct, m2m), from its
+        field name or from its reverse accessor name (like foo_set)
+        Return None if there is no such relation
+        """
+        try:
+            field, model_from, direct, m2m = model._meta.get_field_by_name(name)
+            return field, direct, m2m
+        except FieldDoesNotExist:
+            pass
+        for related in model._meta.get_all_related_objects():
+            if related.get_accessor_name() == name:
+                return related, False, False
+        for related in model._meta.get_all_related_many_to_many_objects():
+            if related.get_accessor_name() == name:
+                return related, False, True
+        return None
+
+    def _prefetch_related(self, objs, name, condition):
+        """
+        Implementation of prefetch_related
+        """
+        model = objs[0].__class__
+        relation = self.get_relation(model, name)
+        if not relation:
+            return None
+        field, direct, m2m = relation
+
+        if direct and m2m and isinstance(field, ManyToManyField):
+            # Not generic relations, which are m2m without a reverse query
+            related_model = field.rel.to
+            query_name = field.related_query_name()
+        elif not direct and not field.field.unique and \
+                not isinstance(field.field, OneToOneField):
+            # Reverse foreign key or many-to-many
+            related_model = field.model
+            query_name = field.field.name
+        else:
+            # A single object (direct or reverse one-to-one), nothing
+            # to prefetch
+            return None
+
+        related = related_model._default_manager.all()
+        if condition:
+            related = related.filter(condition)
+        ids = [ obj.pk for obj in objs ]
+        pairs = list(related.filter(**{ query_name + '__in': ids })
+                     .values_list(query_name, 'pk'))
+
+        loaded = related_model._default_manager.in_bulk(set([ pk for owner, pk in pairs ]))
+        byowner = {}
+        for owner, pk in pairs:
+            if pk in loaded:
+                byowner.setdefault(owner, []).append(loaded[pk])
+        return [ byowner.get(obj.pk, []) for obj in objs ]
+
     def historize(self, **kwargs):
         """
         Historize data to SearchHit
@@ -91,6 +190,11 @@ class DjangoOrmAdapter(OrmAdapter):
         if txlvl == 1:
             # Last subtransaction level ? Commit
             transaction.commit_unless_managed()            
+            if not transaction.is_managed():
+                # Else the writes stay pending until the end of the
+                # request (see signals)
+                from sesql import resultcache
+                resultcache.committed()
 
     def rollback(self, cursor):
         """
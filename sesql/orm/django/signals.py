@@ -17,6 +17,7 @@
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
 from django.conf import settings
+from django.core.signals import request_finished
 from django.db.models import signals
 
 if 'sesql' in settings.INSTALLED_APPS:
@@ -48,3 +49,10 @@ if 'sesql' in settings.INSTALLED_APPS:
     def unindex_cb(sender, instance, *args, **kwargs):
         handle_index(instance, True)
     signals.pre_delete.connect(unindex_cb)
+
+    def request_finished_cb(sender, **kwargs):
+        # Managed transactions of the request are over, their writes
+        # are committed (or rolled back)
+        from sesql import resultcache
+        resultcache.committed()
+    request_finished.connect(request_finished_cb)
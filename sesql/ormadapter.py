@@ -51,6 +51,22 @@ class OrmAdapter(object):
         """
         raise NotImplementedError
 
+    def named_cursor(self, name, withhold = False, scrollable = None):
+        """
+        Give a server-side (named) cursor, fetching rows on demand
+        If withhold is set, the cursor can be used after a commit
+        If scrollable is set, the cursor can be scrolled backwards
+        """
+        raise NotImplementedError
+
+    def release_thread(self):
+        """
+        Called by helper threads (like fan-out queries) once they are
+        done with the database, to end their transaction and close
+        their connection
+        """
+        pass
+
     def begin(self):
         """
         Get a cursor with an open sub-transaction
@@ -64,6 +80,8 @@ class OrmAdapter(object):
         Commit sub-transaction on cursor
         """
         cursor.execute('RELEASE SAVEPOINT sesql_savepoint')
+        from sesql import resultcache
+        resultcache.committed()
 
     def rollback(self, cursor):
         """
@@ -96,6 +114,25 @@ class OrmAdapter(object):
         transactional_inner.__name__ = function.__name__
         return transactional_inner
 
+    def transactional_once(self, function):
+        """
+        Wrap a function to have a sub-transaction-bound cursor, without
+        re-attempting it on failure (for batches, which callers retry
+        one by one)
+        """
+        def transactional_once_inner(*args, **kwargs):
+            cursor = self.begin()
+            try:
+                res = function(cursor, *args, **kwargs)
+                self.commit(cursor)
+                return res
+            except Exception, e:
+                self.rollback(cursor)
+                log.warning('function %s failed with %s' % (function.__name__, e))
+                raise
+        transactional_once_inner.__name__ = function.__name__
+        return transactional_once_inner
+
 
     #
     # More specific methods
@@ -113,7 +150,31 @@ class OrmAdapter(object):
         Load an object from its class and id
         """
         raise NotImplementedError
+
+    def load_objects(self, klass, ids):
+        """
+        Load at once the objects of a class from their ids
+        Return a dict mapping ids to objects, missing objects being
+        left out
+        """
+        res = {}
+        for oid in ids:
+            try:
+                res[oid] = self.load_object(klass, oid)
+            except self.not_found:
+                pass
+        return res
         
+    def prefetch_related(self, objs, name, condition = None):
+        """
+        Load at once the objects related to each of those objects (of
+        the same class) through the many-valued relation name, filtered
+        by condition
+        Return a list with the related objects of each object, or None
+        if it can't be done
+        """
+        return None
+
     def historize(self, **kwargs):
         """
         Historize data to SearchHit
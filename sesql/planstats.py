@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Statistics on the smart queries, used to plan them : for each table
+and shape of query, the ratio of the rows of the smart subquery which
+match the query
+"""
+import threading
+import logging
+
+from GenericCache import GenericCache
+
+from sesql import config
+
+log = logging.getLogger('sesql')
+
+
+class PlanStats(object):
+    """
+    Per-process store of the observed match ratios, as a moving average
+    """
+    def __init__(self, maxsize = 10000, expiry = 3600, weight = 0.3):
+        """
+        Constructor
+        weight is the weight of a new observation in the average ;
+        statistics expire, so shapes sent to plan C get a new chance
+        """
+        self.ratios = GenericCache(maxsize = maxsize, expiry = expiry)
+        self.weight = weight
+        self.lock = threading.Lock()
+
+    def get(self, table, shape):
+        """
+        Get the estimated match ratio, None if unknown
+        """
+        return self.ratios.fetch((table, shape))
+
+    def record(self, table, shape, size, found, limit):
+        """
+        Record a smart query on a subquery of given size, which found
+        that many rows (at most limit)
+        """
+        key = (table, shape)
+        ratio = float(found) / float(size)
+        self.lock.acquire()
+        try:
+            previous = self.ratios.fetch(key)
+            if found >= limit:
+                # Only a lower bound of the ratio
+                if previous is not None and previous > ratio:
+                    return
+            elif previous is not None:
+                ratio = previous + (ratio - previous) * self.weight
+            self.ratios.insert(key, ratio)
+        finally:
+            self.lock.release()
+        log.debug("Match ratio of %s on %s is now %f" % (shape, table, ratio))
+
+planstats = PlanStats(getattr(config, 'PLAN_STATS_MAX_SIZE', 10000),
+                      getattr(config, 'PLAN_STATS_EXPIRY', 3600))
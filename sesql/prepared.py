@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Server-side prepared statements : each statement is PREPAREd once on
+each connection, then EXECUTEd, so PostgreSQL doesn't plan it again
+"""
+import re
+import hashlib
+import logging
+import itertools
+import threading
+from sesql import config
+from collections import OrderedDict
+
+log = logging.getLogger('sesql')
+
+_placeholder = re.compile('%[s%]')
+
+# Names of the statements prepared on each connection, by (id, backend pid),
+# from the least to the most recently used
+_prepared = {}
+_lock = threading.Lock()
+MAX_CONNECTIONS = 1000
+MAX_STATEMENTS = 100
+
+# Statements which can't be prepared (types of parameters not guessed, ...)
+_unpreparable = set()
+
+def to_positional(query):
+    """
+    Convert the %s placeholders of a query to $1, $2, ...
+    """
+    counter = itertools.count(1)
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+        return '$%d' % counter.next()
+    return _placeholder.sub(replace, query)
+
+def get_prepared(connection):
+    """
+    Get the statements prepared on this connection, as an ordered dict
+    """
+    key = (id(connection), connection.get_backend_pid())
+    _lock.acquire()
+    try:
+        if not key in _prepared and len(_prepared) >= MAX_CONNECTIONS:
+            # Forget closed connections ; statements still prepared on
+            # the others will be detected when preparing them again
+            _prepared.clear()
+        return _prepared.setdefault(key, OrderedDict())
+    finally:
+        _lock.release()
+
+def prepare(cursor, name, query):
+    """
+    Prepare the statement, return False if it can't be done
+    """
+    cursor.execute("SAVEPOINT sesql_prepare")
+    try:
+        cursor.execute("PREPARE %s AS %s" % (name, to_positional(query)))
+    except Exception, e:
+        cursor.execute("ROLLBACK TO SAVEPOINT sesql_prepare")
+        if getattr(e, "pgcode", None) == "42P05":
+            # Already prepared
+            return True
+        log.warning("Can't prepare %r : %s" % (query, e))
+        _unpreparable.add(name)
+        return False
+    cursor.execute("RELEASE SAVEPOINT sesql_prepare")
+    return True
+
+def deallocate(cursor, name):
+    """
+    Deallocate the statement, if it still exists
+    """
+    cursor.execute("SAVEPOINT sesql_deallocate")
+    try:
+        cursor.execute("DEALLOCATE %s" % name)
+    except Exception, e:
+        cursor.execute("ROLLBACK TO SAVEPOINT sesql_deallocate")
+        if getattr(e, "pgcode", None) != "26000":
+            raise
+    else:
+        cursor.execute("RELEASE SAVEPOINT sesql_deallocate")
+
+def run(cursor, name, values):
+    """
+    Execute the prepared statement
+    """
+    if values:
+        cursor.execute("EXECUTE %s (%s)" % (name, ','.join([ "%s" ] * len(values))),
+                       values)
+    else:
+        cursor.execute("EXECUTE %s" % name)
+
+def run_known(cursor, name, values):
+    """
+    Execute a statement recorded as prepared, return False if it
+    doesn't exist anymore on the server (DISCARD ALL, transaction
+    pooling, reconnection, ...)
+    """
+    cursor.execute("SAVEPOINT sesql_execute")
+    try:
+        run(cursor, name, values)
+    except Exception, e:
+        cursor.execute("ROLLBACK TO SAVEPOINT sesql_execute")
+        if getattr(e, "pgcode", None) == "26000":
+            return False
+        raise
+    # From another cursor, to keep the results of this one
+    cursor.connection.cursor().execute("RELEASE SAVEPOINT sesql_execute")
+    return True
+
+def execute(cursor, query, values):
+    """
+    Execute the query on the cursor, through a prepared statement
+    """
+    name = "sesql_%s" % hashlib.md5(query).hexdigest()[:24]
+    if name in _unpreparable:
+        cursor.execute(query, values)
+        return
+
+    prepared = get_prepared(cursor.connection)
+    if name in prepared:
+        # Mark it as the most recently used
+        del prepared[name]
+        if run_known(cursor, name, values):
+            prepared[name] = True
+            return
+        # The others most likely vanished too
+        log.info("Statement %s vanished from the server, preparing it again" % name)
+        prepared.clear()
+
+    if not prepare(cursor, name, query):
+        cursor.execute(query, values)
+        return
+    limit = getattr(config, 'PREPARED_STATEMENTS_MAX', MAX_STATEMENTS)
+    while len(prepared) >= limit:
+        evicted, _ = prepared.popitem(last = False)
+        deallocate(cursor, evicted)
+    prepared[name] = True
+    run(cursor, name, values)
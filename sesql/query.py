@@ -16,15 +16,25 @@
 
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+import heapq
 import logging
+import itertools
+import threading
 
 from sesql import config
 from sesql.typemap import typemap
 from sesql.fieldmap import fieldmap
-from sesql.results import SeSQLResultSet
+from sesql.results import SeSQLResultSet, StreamedRows
+from sesql.planstats import planstats
+from sesql.fields import FullTextField
+from sesql import termstats
+from sesql import prepared
 
 log = logging.getLogger('sesql')
 
+# Unique names for the server-side cursors
+_stream_ids = itertools.count()
+
 def cached(method):
     """
     Decorator to make a method without argument to store result
@@ -43,6 +53,59 @@ def cached(method):
         return value
     return cached_inner
 
+class SortKey(object):
+    """
+    Sort key of a row, from a list of (value, descending), sorting
+    NULL values like PostgreSQL does (last in ascending order, first in
+    descending order)
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        """
+        Constructor
+        """
+        self.values = values
+
+    def __cmp__(self, other):
+        for (mine, desc), (theirs, _) in zip(self.values, other.values):
+            if mine is None or theirs is None:
+                res = cmp(mine is None, theirs is None)
+            else:
+                res = cmp(mine, theirs)
+            if res:
+                return desc and -res or res
+        return 0
+
+# Thread pool running the per-table queries of fan-out queries
+_fanout_pool = None
+_fanout_lock = threading.Lock()
+
+def get_fanout_pool():
+    """
+    Get the fan-out thread pool, of FANOUT_THREADS threads, creating it
+    if needed
+    """
+    global _fanout_pool
+    _fanout_lock.acquire()
+    try:
+        if _fanout_pool is None:
+            from multiprocessing.pool import ThreadPool
+            _fanout_pool = ThreadPool(config.FANOUT_THREADS)
+        return _fanout_pool
+    finally:
+        _fanout_lock.release()
+
+def _fanout_worker(args):
+    """
+    Perform the smart query of one table, in a fan-out thread
+    """
+    query, limit = args
+    try:
+        return list(query._do_smart_query(limit))
+    finally:
+        config.orm.release_thread()
+
 class SeSQLQuery(object):
     """
     SeSQL Query handler
@@ -57,6 +120,9 @@ class SeSQLQuery(object):
             order = order.split(',')
         self.order = order
         self.fields = ('classname', 'id') + tuple(fields)
+        self.tsqueries = []
+        # Marshalled full text queries, shared by filtering and ranking
+        self.marshalled = {}
 
     def execute(self, query, values):
         """
@@ -64,40 +130,97 @@ class SeSQLQuery(object):
         """
         cursor = config.orm.cursor()
         log.debug("Query %r with values %r" % (query, values))
-        cursor.execute(query, values)
+        if getattr(config, 'PREPARED_STATEMENTS', False):
+            prepared.execute(cursor, query, values)
+        else:
+            cursor.execute(query, values)
         return cursor
 
-    def longquery(self, limit = None):
+    def longquery(self, limit = None, stream = False, withhold = False):
         """
         Perform a long query and return a lazy Django result set
+
+        In stream mode, rows are fetched by batches of STREAM_BATCH_SIZE
+        from a server-side cursor, as the result set is used ; the
+        cursor only lives until the end of the transaction, unless
+        withhold is set
         """
+        if stream:
+            return self._do_streamed_longquery(limit, withhold)
         query = self._do_longquery(limit)
         if limit:
             query = query.fetchmany(limit)
         return SeSQLResultSet(list(query), self.fields)
 
+    def _do_streamed_longquery(self, limit = None, withhold = False):
+        """
+        Perform a long query on a server-side cursor, and return a
+        result set streaming from it
+        """
+        query, values = self._get_longquery(limit)
+        name = "sesql_stream_%d" % _stream_ids.next()
+        cursor = config.orm.named_cursor(name, withhold = withhold,
+                                         scrollable = True)
+        log.debug("Query %r with values %r on cursor %s" % (query, values, name))
+        cursor.execute(query, values)
+
+        def count():
+            nb = self.count()
+            if limit:
+                nb = min(nb, limit)
+            return nb
+
+        batch_size = getattr(config, 'STREAM_BATCH_SIZE', 1000)
+        return SeSQLResultSet(StreamedRows(cursor, count, batch_size),
+                              self.fields)
+
+    @cached
+    def count(self):
+        """
+        Count the matching rows
+        """
+        table = self.get_table_name()
+        pattern, values = self.get_pattern()
+        w_query, w_values, w_join = self.get_with()
+        query = """%sSELECT count(*)
+FROM %s%s
+WHERE %s""" % (w_query, table, w_join, pattern)
+        return self.execute(query, w_values + values).fetchone()[0]
+
     def _do_longquery(self, limit = None):
         """
         Perform a long query and return a cursor
         """
+        query, values = self._get_longquery(limit)
+        return self.execute(query, values)
+
+    def _get_longquery(self, limit = None):
+        """
+        Get the long query and its values
+        """
         table = self.get_table_name()
         pattern, values = self.get_pattern()
         o_pattern, o_values = self.get_order()
+        w_query, w_values, w_join = self.get_with()
 
-        query = """SELECT %s
-FROM %s
+        query = """%sSELECT %s
+FROM %s%s
 WHERE %s
-ORDER BY %s""" % (', '.join(self.fields), table, pattern, o_pattern)
+ORDER BY %s""" % (w_query, ', '.join(self.fields), table, w_join,
+                  pattern, o_pattern)
+        values = w_values + values + o_values
         if limit:
             query += """
-LIMIT %d""" % limit
+LIMIT %s"""
+            values = values + [ limit ]
 
-        return self.execute(query, values + o_values)
+        return query, values
 
     @cached
     def _get_smart_query(self):
         """
-        Get the template for performing smart queries
+        Get the template for performing smart queries, and the values
+        to put before and after the size of the smart subquery
         """
         table = self.get_table_name()
         pattern, values = self.get_pattern()
@@ -106,6 +229,7 @@ LIMIT %d""" % limit
         classes = self.get_classes()
         l_pattern, l_values = fieldmap.get_field("classname").get_in(classes)
         l_order, _ = self.get_order(limit = 1)
+        w_query, w_values, w_join = self.get_with()
 
         cursor = config.orm.cursor()
 
@@ -114,28 +238,71 @@ LIMIT %d""" % limit
         # handle well the cases of many matches
         #
 
-        smartquery = """SELECT %s
-FROM  (SELECT * FROM %s WHERE %s ORDER BY %s LIMIT {SESQL_SMART_LIMIT}) subquery
-WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
-                                                   table, l_pattern, l_order,
-                                                   pattern, o_pattern)
-        return smartquery, l_values + values + o_values
+        smartquery = """%sSELECT %s
+FROM  (SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT %%s) subquery%s
+WHERE %s ORDER BY %s LIMIT %%s""" % (w_query, ', '.join(self.fields),
+                                     ', '.join(self.get_columns()),
+                                     table, l_pattern, l_order,
+                                     w_join, pattern, o_pattern)
+        return smartquery, w_values + l_values, values + o_values
+
+    def _get_short_query(self, size, limit):
+        """
+        Get a short query of given size and its values
+        """
+        smartquery, before, after = self._get_smart_query()
+        return smartquery, before + [ size ] + after + [ limit ]
 
     def _attempt_short_query(self, size, limit):
         """
         Attempt a short query of given size
         """
-        smartquery, values = self._get_smart_query()
-        query = smartquery.replace('{SESQL_SMART_LIMIT}', str(size))
-        query = query.replace('{SESQL_THE_LIMIT}', str(limit))
+        query, values = self._get_short_query(size, limit)
         return self.execute(query, values)
 
+    def get_smart_size(self, limit):
+        """
+        Get the size of the first smart subquery to attempt, or None to
+        go straight to plan C
+        With SMART_QUERY_ADAPTIVE, it is computed from the match ratio
+        observed on previous queries of the same shape, or else from the
+        term statistics
+        """
+        ratio = None
+        if getattr(config, 'SMART_QUERY_ADAPTIVE', False):
+            ratio = planstats.get(self.get_table_name(), self.get_shape())
+            if ratio is None:
+                ratio = self.estimate_fraction()
+        if ratio is None:
+            return config.SMART_QUERY_INITIAL
+
+        max_size = getattr(config, 'SMART_QUERY_MAX_SIZE', 50000)
+        if ratio * max_size < limit:
+            log.debug("Expected match ratio %f too low, going to Query Plan C" % ratio)
+            return None
+        size = int(limit / ratio * config.SMART_QUERY_RATIO)
+        return min(max(size, limit), max_size)
+
+    def record_smart_query(self, size, found, limit):
+        """
+        Record the result of a smart subquery, for the adaptive planner
+        """
+        if getattr(config, 'SMART_QUERY_ADAPTIVE', False):
+            planstats.record(self.get_table_name(), self.get_shape(),
+                             size, found, limit)
+
     def _do_smart_query(self, limit):
         """
         Perform a smart query, returning cursor
         """
+        size = self.get_smart_size(limit)
+        if size is None:
+            log.debug("Using Query Plan C")
+            return self._do_longquery(limit)
+
         # Ok we can do a short query
-        cursor = self._attempt_short_query(config.SMART_QUERY_INITIAL, limit)
+        cursor = self._attempt_short_query(size, limit)
+        self.record_smart_query(size, cursor.rowcount, limit)
         if cursor.rowcount >= limit:
             log.debug("Found data with Query Plan A")
             return cursor
@@ -147,8 +314,9 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
             # Not enough, but promising, let's try again
             ratio = float(limit) / float(cursor.rowcount)
             ratio *= config.SMART_QUERY_RATIO
-            sl = int(config.SMART_QUERY_INITIAL * ratio)
+            sl = int(size * ratio)
             cursor = self._attempt_short_query(sl, limit)
+            self.record_smart_query(sl, cursor.rowcount, limit)
             if cursor.rowcount >= limit:
                 log.debug("Found data with Query Plan B")
                 return cursor
@@ -157,27 +325,270 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
         log.debug("Using Query Plan C")
         return self._do_longquery(limit)
 
-    def shortquery(self, limit = 50):
+    def _do_multitable_query(self, limit):
         """
-        Perform a long query and return a lazy Django result set
+        Perform a smart query on each table of a multi-table query,
+        merged with UNION ALL, and return the rows
+        Tables for which the smart query didn't give enough rows go
+        through plans B and C, like in _do_smart_query
+        """
+        queries = self.get_table_queries()
+        tables = sorted(queries)
+
+        # Size of the smart subquery of each table, None for plan C
+        sizes = dict([ (table, queries[table].get_smart_size(limit))
+                       for table in tables ])
+        plans = dict([ (table, sizes[table] is None and "C" or "A")
+                       for table in tables ])
+
+        o_pattern, o_values = self.get_order()
+        while True:
+            branches = []
+            values = []
+            for table in tables:
+                if sizes[table] is None:
+                    query, vals = queries[table]._get_longquery(limit)
+                else:
+                    query, vals = queries[table]._get_short_query(sizes[table],
+                                                                  limit)
+                branches.append("(%s)" % query)
+                values.extend(vals)
+            query = """SELECT %s
+FROM (%s) sesql_union
+ORDER BY %s""" % (', '.join(self.fields), "\nUNION ALL\n".join(branches),
+                  o_pattern)
+            rows = self.execute(query, values + o_values).fetchall()
+
+            counts = dict([ (table, 0) for table in tables ])
+            for row in rows:
+                counts[typemap.get_table_for(row[0])] += 1
+
+            retry = False
+            for table in tables:
+                count = counts[table]
+                if sizes[table] is not None:
+                    queries[table].record_smart_query(sizes[table], count, limit)
+                if count >= limit or sizes[table] is None:
+                    continue
+                retry = True
+                if plans[table] == "A" and count and \
+                        count >= limit * config.SMART_QUERY_THRESOLD:
+                    ratio = float(limit) / float(count)
+                    ratio *= config.SMART_QUERY_RATIO
+                    sizes[table] = int(sizes[table] * ratio)
+                    plans[table] = "B"
+                else:
+                    sizes[table] = None
+                    plans[table] = "C"
+            if not retry:
+                break
+            log.debug("Found %r rows, trying Query Plans %r" % (counts, plans))
+
+        log.debug("Found data with Query Plans %r" % plans)
+        return rows[:limit]
+
+    def _do_fanout_query(self, limit):
+        """
+        Perform concurrently the smart query of each table of a
+        multi-table query, in the fan-out thread pool, and merge the
+        sorted results ; return the rows
+        """
+        queries = self.get_table_queries()
+        tables = sorted(queries)
+        results = get_fanout_pool().map(_fanout_worker,
+                                        [ (queries[table], limit) for table in tables ])
+
+        # Rows are (classname, id, fields..., order columns...)
+        fields = queries[tables[0]].fields
+        positions = []
+        for o in self.order:
+            if o[0] == '-':
+                positions.append((fields.index(o[1:]), True))
+            else:
+                positions.append((fields.index(o), False))
+
+        def keyed(rows):
+            for row in rows:
+                yield SortKey([ (row[i], desc) for i, desc in positions ]), row
+
+        merged = heapq.merge(*[ keyed(rows) for rows in results ])
+        nb = len(self.fields)
+        return [ row[:nb] for key, row in itertools.islice(merged, limit) ]
+
+    def _do_relevance_query(self, limit):
+        """
+        Perform a query sorted on relevance, ranking only the
+        RELEVANCE_CANDIDATES first matching rows according to
+        RELEVANCE_CANDIDATES_ORDER
+        Return a cursor
         """
         table = self.get_table_name()
+        pattern, values = self.get_pattern()
+        o_pattern, o_values = self.get_order()
 
-        if table == config.MASTER_TABLE_NAME:
-            # Multitable or unprecise query ? Falling back to longquery
-            log.warning("Query on master table will not be optimized on %s" % self.query)
-            return self.longquery(limit)
+        order = config.RELEVANCE_CANDIDATES_ORDER
+        if isinstance(order, (str, unicode)):
+            order = order.split(',')
+        c_order = []
+        for o in order:
+            if o[0] == '-':
+                c_order.append("%s DESC" % o[1:])
+            else:
+                c_order.append("%s ASC" % o)
+        c_order = c_order and "ORDER BY %s " % ','.join(c_order) or ""
+        w_query, w_values, w_join = self.get_with()
+
+        query = """%sSELECT %s
+FROM  (SELECT %s FROM %s%s WHERE %s %sLIMIT %%s) candidates%s
+ORDER BY %s LIMIT %%s""" % (w_query, ', '.join(self.fields),
+                            ', '.join(self.get_columns()), table, w_join,
+                            pattern, c_order, w_join, o_pattern)
+        return self.execute(query, w_values + values +
+                            [ config.RELEVANCE_CANDIDATES ] + o_values +
+                            [ limit ])
 
+    def shortquery(self, limit = 50):
+        """
+        Perform a long query and return a lazy Django result set
+        """
         if "sesql_relevance"  in self.order or "-sesql_relevance" in self.order:
+            if getattr(config, 'RELEVANCE_CANDIDATES', 0) and \
+                    getattr(config, 'RELEVANCE_CANDIDATES_ORDER', None):
+                log.debug("Trying top-k relevance query for %s" % self.query)
+                cursor = self._do_relevance_query(limit)
+                return SeSQLResultSet(list(cursor), self.fields)
             # Order on relevance ? Falling back to longquery
             log.info("Query sorting on relevance will not be optimized on %s" % self.query)
             return self.longquery(limit)
 
+        table = self.get_table_name()
+
+        if table == config.MASTER_TABLE_NAME:
+            if len(self.get_tables()) > 1:
+                log.debug("Trying multi-table short query for %s" % self.query)
+                if getattr(config, 'FANOUT_THREADS', 0):
+                    rows = self._do_fanout_query(limit)
+                else:
+                    rows = self._do_multitable_query(limit)
+                return SeSQLResultSet(list(rows), self.fields)
+
+            # Unprecise query ? Falling back to longquery
+            log.warning("Query on master table will not be optimized on %s" % self.query)
+            return self.longquery(limit)
+
         log.debug("Trying short query for %s" % self.query)
 
         cursor = self._do_smart_query(limit)
         return SeSQLResultSet(list(cursor), self.fields)
 
+    def keysetquery(self, limit = 50, after = None):
+        """
+        Perform a keyset (seek) query : return the limit rows following
+        the row whose sort key is after (from the first row if None)
+        The sort key of the last row is stored in the next_key attribute
+        of the result set (None on the last page)
+        """
+        keys = self.get_keyset_order()
+        names = [ name for name, direction in keys ]
+        fields = self.fields + tuple([ name for name in names
+                                       if name not in self.fields ])
+
+        table = self.get_table_name()
+        pattern, values = self.get_pattern()
+        o_pattern = ','.join([ "%s %s" % key for key in keys ])
+
+        if after:
+            if len(after) != len(keys):
+                raise ValueError, "keyset requires a value for each of %s" % ','.join(names)
+            k_pattern, k_values = self.get_keyset_pattern(keys, after)
+            pattern = "(%s) AND (%s)" % (pattern, k_pattern)
+            values = values + k_values
+        w_query, w_values, w_join = self.get_with()
+
+        query = """%sSELECT %s
+FROM %s%s
+WHERE %s
+ORDER BY %s
+LIMIT %%s""" % (w_query, ', '.join(fields), table, w_join, pattern,
+                o_pattern)
+
+        rows = self.execute(query, w_values + values + [ limit ]).fetchall()
+        results = SeSQLResultSet(list(rows), fields)
+        results.next_key = None
+        if len(rows) == limit:
+            last = dict(zip(fields, rows[-1]))
+            results.next_key = tuple([ last[name] for name in names ])
+        return results
+
+    @cached
+    def get_keyset_order(self):
+        """
+        Get the order as a list of (column, direction), ending with
+        classname and id so the order is total
+        """
+        keys = []
+        for o in self.order:
+            if o[0] == '-':
+                keys.append((o[1:], "DESC"))
+            else:
+                keys.append((o, "ASC"))
+            if keys[-1][0].startswith("sesql_"):
+                raise ValueError, "%s can't be used with keyset queries" % keys[-1][0]
+
+        names = [ name for name, direction in keys ]
+        for name in ('classname', 'id'):
+            if name not in names:
+                keys.append((name, keys and keys[-1][1] or "ASC"))
+        return keys
+
+    def get_keyset_pattern(self, keys, after):
+        """
+        Get the pattern selecting rows after the given sort key
+
+        NULL values sort as PostgreSQL does by default : after all the
+        others in ASC order, before them in DESC order
+        """
+        directions = set([ direction for name, direction in keys ])
+        if directions == set([ "DESC" ]) and None not in after:
+            # Row comparison, which can use a multi-columns index ; rows
+            # with NULL values, which it doesn't select, all come before
+            pattern = "(%s) < (%s)" % (','.join([ name for name, direction in keys ]),
+                                       ','.join([ "%s" for key in keys ]))
+            return pattern, list(after)
+
+        # General case : (a > x) OR (a = x AND b < y) OR ...
+        patterns = []
+        values = []
+        for i, (name, direction) in enumerate(keys):
+            value = after[i]
+            if direction == "ASC" and value is None:
+                # Nothing comes after NULL in ASC order
+                continue
+
+            terms = []
+            vals = []
+            for (prev, _), prev_value in zip(keys[:i], after[:i]):
+                if prev_value is None:
+                    terms.append("%s IS NULL" % prev)
+                else:
+                    terms.append("%s = %%s" % prev)
+                    vals.append(prev_value)
+
+            if direction == "DESC" and value is None:
+                terms.append("%s IS NOT NULL" % name)
+            elif direction == "DESC":
+                terms.append("%s < %%s" % name)
+                vals.append(value)
+            elif name in ("classname", "id"):
+                terms.append("%s > %%s" % name)
+                vals.append(value)
+            else:
+                terms.append("(%s > %%s OR %s IS NULL)" % (name, name))
+                vals.append(value)
+            patterns.append("(%s)" % " AND ".join(terms))
+            values.extend(vals)
+        return " OR ".join(patterns), values
+
     @cached
     def get_table_name(self):
         """
@@ -193,6 +604,37 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
             return config.MASTER_TABLE_NAME
         return tables.pop()
 
+    @cached
+    def get_tables(self):
+        """
+        Get the tables involved in the query, as a dict associating each
+        table to the classes of the query it holds
+        Empty if the classes are not known
+        """
+        tables = {}
+        for k in self.get_classes():
+            table = typemap.get_table_for(k)
+            if not table:
+                return {}
+            tables.setdefault(table, []).append(k)
+        return tables
+
+    @cached
+    def get_table_queries(self):
+        """
+        Get a query for each table involved in the query, restricted to
+        the classes of that table, and fetching the order columns
+        """
+        order = [ o.lstrip('-') for o in self.order ]
+        extra = self.fields[2:] + tuple([ o for o in order
+                                          if o not in self.fields ])
+        node_class = config.orm.node_class
+        queries = {}
+        for table, classes in self.get_tables().items():
+            query = node_class(classname__in = classes) & self.query
+            queries[table] = SeSQLQuery(query, self.order, extra)
+        return queries
+
     @cached
     def get_classes(self):
         """
@@ -229,6 +671,137 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
         if key == field or key.startswith(field + '__'):
             return node
 
+    @cached
+    def estimate_fraction(self):
+        """
+        Estimate the fraction of the rows of the table matching the full
+        text filters of the query, from the term statistics, assuming
+        words are independent
+        Return None if it can't be estimated
+        """
+        table = self.get_table_name()
+        if not getattr(config, 'TERM_STATS', False) or table == config.MASTER_TABLE_NAME:
+            return None
+
+        fraction = None
+        for field, method, value in self._find_fulltext_nodes(self.query):
+            if method == "matches" and ('|' in value or '!' in value):
+                # Only AND queries can be estimated
+                continue
+            words = termstats.get_lexemes(field, value)
+            frequencies = termstats.get_frequencies(table, field, words)
+            if frequencies is None or None in frequencies.values():
+                # Unknown words : use the non-adaptive plan rather than
+                # guessing no row matches
+                return None
+            for frequency in frequencies.values():
+                fraction = (fraction is None and 1.0 or fraction) * frequency
+        return fraction
+
+    def estimate_count(self):
+        """
+        Estimate the number of rows of the table matching the full text
+        filters of the query, None if it can't be estimated
+        """
+        fraction = self.estimate_fraction()
+        if fraction is None:
+            return None
+        field = self._find_fulltext_nodes(self.query)[0][0]
+        return int(fraction * termstats.get_total(self.get_table_name(), field))
+
+    def _find_fulltext_nodes(self, node):
+        """
+        Find the full text filters which all matching rows must pass,
+        as a list of (field, method, value)
+        """
+        if isinstance(node, config.orm.node_class):
+            if node.negated or node.connector != 'AND':
+                return []
+            res = []
+            for child in node.children:
+                res.extend(self._find_fulltext_nodes(child))
+            return res
+
+        key, value = node
+        if not "__" in key:
+            return []
+        name, method = key.split("__", 1)
+        field = fieldmap.fields_map.get(name)
+        if isinstance(field, FullTextField) and \
+                method in ("containswords", "containsexact", "matches"):
+            return [ (field, method, value) ]
+        return []
+
+    @cached
+    def get_columns(self):
+        """
+        Get the columns used by the query : fetched fields, order and
+        filters
+        """
+        columns = list(self.fields)
+        for o in self.order:
+            o = o.lstrip('-')
+            if o == "sesql_relevance":
+                columns.append(fieldmap.get_primary().index_column)
+            else:
+                columns.append(o)
+        columns.extend(self.get_columns_for(self.query))
+
+        res = []
+        for column in columns:
+            if column not in res:
+                res.append(column)
+        return res
+
+    def get_columns_for(self, node):
+        """
+        Get the columns used by the filters of a node of the query
+        """
+        if isinstance(node, config.orm.node_class):
+            res = []
+            for child in node.children:
+                res.extend(self.get_columns_for(child))
+            return res
+
+        query, value = node
+        if "__" in query:
+            field, method = query.split("__", 1)
+        else:
+            field = query
+            method = "default"
+        return fieldmap.get_field(field).get_columns(method)
+
+    def get_cache_key(self, limit = None):
+        """
+        Get a key identifying the results of the query : table, SQL
+        patterns and their values, fields and limit
+        """
+        pattern, values = self.get_pattern()
+        o_pattern, o_values = self.get_order()
+        return repr((self.get_table_name(), pattern, values, o_pattern,
+                     o_values, self.tsqueries, self.fields, limit))
+
+    @cached
+    def get_shape(self):
+        """
+        Get the shape of the query : the fields and operators used, and
+        the order, but not the values
+        """
+        return "%s ORDER BY %s" % (self.get_shape_for(self.query),
+                                   ','.join(self.order))
+
+    def get_shape_for(self, node):
+        """
+        Get the shape of a node of the query
+        """
+        if isinstance(node, config.orm.node_class):
+            shapes = sorted([ self.get_shape_for(child) for child in node.children ])
+            shape = "(%s)" % (" %s " % node.connector).join(shapes)
+            if node.negated:
+                shape = "NOT " + shape
+            return shape
+        return node[0]
+
     @cached
     def get_pattern(self):
         """
@@ -268,9 +841,46 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
             method = "default"
 
         field = fieldmap.get_field(field)
+        if isinstance(field, FullTextField) and \
+                method in ("containswords", "containsexact", "matches"):
+            share = None
+            if getattr(config, 'SHARED_TSQUERY', False):
+                share = self.share_tsquery
+            return getattr(field, "get_" + method)(value, share = share,
+                                                   memo = self.marshalled)
         method = getattr(field, "get_" + method)
         return method(value)
 
+    def share_tsquery(self, pattern, values):
+        """
+        Register a tsquery to compute once in the WITH clause of the
+        statements, and get the expression to use it
+        """
+        values = list(values)
+        for i, tsquery in enumerate(self.tsqueries):
+            if tsquery == (pattern, values):
+                break
+        else:
+            i = len(self.tsqueries)
+            self.tsqueries.append((pattern, values))
+        return "sesql_tsq.q%d" % i
+
+    def get_with(self):
+        """
+        Get the WITH clause computing the shared tsqueries, its values
+        and the join clause to use them, as (with, values, join)
+        Must be called once the patterns of the statement are computed
+        """
+        if not self.tsqueries:
+            return "", [], ""
+        columns = []
+        values = []
+        for i, (pattern, vals) in enumerate(self.tsqueries):
+            columns.append("%s AS q%d" % (pattern, i))
+            values.extend(vals)
+        return ("WITH sesql_tsq AS (SELECT %s)\n" % ', '.join(columns),
+                values, ", sesql_tsq")
+
     @cached
     def get_order(self, limit = None):
         """
@@ -297,6 +907,8 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
                     log.warning("No full text query, ignoring relevance in %s" % self.query)
                     continue
                 field, what, value = query
+                if getattr(config, 'SHARED_TSQUERY', False):
+                    what, value = self.share_tsquery(what, value), []
                 o = "ts_rank_cd(%s, %s)" % (field, what)
                 values.extend(value)
 
@@ -325,5 +937,5 @@ WHERE %s ORDER BY %s LIMIT {SESQL_THE_LIMIT}""" % (', '.join(self.fields),
             method = "default"
 
         method = getattr(field, "rank_" + method)
-        return method(value)
+        return method(value, memo = self.marshalled)
 
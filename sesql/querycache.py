@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Backends for the long query cache, which stores result sets by queryid
+"""
+import cPickle
+import logging
+
+import psycopg2
+from GenericCache import GenericCache
+
+from sesql import config
+from sesql.results import SeSQLResultSet
+
+log = logging.getLogger('sesql')
+
+
+class QueryCache(object):
+    """
+    Abstract class for query cache backends
+    """
+    def get(self, queryid):
+        """
+        Get the result set stored for this queryid, None if not found
+        """
+        raise NotImplementedError
+
+    def set(self, queryid, results):
+        """
+        Store the result set for this queryid
+        """
+        raise NotImplementedError
+
+    def __contains__(self, queryid):
+        return self.get(queryid) is not None
+
+class SizedCache(GenericCache):
+    """
+    A GenericCache also bounded by the total size in bytes of its values,
+    as given by their nbytes() method
+    """
+    def __init__(self, maxbytes = None, **kwargs):
+        """
+        Constructor
+        """
+        GenericCache.__init__(self, **kwargs)
+        self.maxbytes = maxbytes
+        self.sizes = {}
+        self.nbytes = 0
+
+    def insert(self, key, value):
+        """
+        Insert an object, evicting the least recently used ones if needed
+        """
+        self.lock.acquire()
+        try:
+            self.remove(key)
+            size = value.nbytes()
+            self.sizes[str(key)] = size
+            self.nbytes += size
+            GenericCache.insert(self, key, value)
+            if self.maxbytes:
+                while len(self.values) > 1 and self.nbytes > self.maxbytes:
+                    self.remove(self.lru.pop())
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        """
+        Expire a value
+        """
+        self.lock.acquire()
+        try:
+            self.nbytes -= self.sizes.pop(str(key), 0)
+            GenericCache.remove(self, key)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """
+        Clear the whole cache
+        """
+        self.lock.acquire()
+        try:
+            self.sizes.clear()
+            self.nbytes = 0
+            GenericCache.clear(self)
+        finally:
+            self.lock.release()
+
+    __setitem__ = insert
+    __delitem__ = remove
+
+class LocalQueryCache(QueryCache):
+    """
+    In-process cache, not shared between processes
+    Bounded by QUERY_CACHE_MAX_SIZE queries, and by QUERY_CACHE_MAX_BYTES
+    bytes if set
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.cache = SizedCache(maxbytes = getattr(config, 'QUERY_CACHE_MAX_BYTES', None),
+                                maxsize = config.QUERY_CACHE_MAX_SIZE,
+                                expiry = config.QUERY_CACHE_EXPIRY)
+
+    def get(self, queryid):
+        """
+        Get the result set stored for this queryid, None if not found
+        """
+        self.cache.lock.acquire()
+        try:
+            return self.cache[queryid]
+        finally:
+            self.cache.lock.release()
+
+    def set(self, queryid, results):
+        """
+        Store the result set for this queryid
+        """
+        self.cache.lock.acquire()
+        try:
+            self.cache[queryid] = results
+        finally:
+            self.cache.lock.release()
+
+class PgQueryCache(QueryCache):
+    """
+    Cache shared by all processes and hosts, stored in an UNLOGGED
+    PostgreSQL table (the content is lost on a database crash, which is
+    fine for a cache)
+
+    Entries are pickled : anyone able to write to the table can run
+    code in the processes reading it
+    """
+    TABLE_NAME = "sesql_query_cache"
+
+    # Purge expired entries every PURGE_EVERY insertions
+    PURGE_EVERY = 100
+
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.nb_set = 0
+
+    def get(self, queryid):
+        """
+        Get the result set stored for this queryid, None if not found
+        """
+        cursor = config.orm.cursor()
+        cursor.execute("""SELECT data FROM %s
+                          WHERE queryid = %%s AND expires_at > NOW()""" % self.TABLE_NAME,
+                       (queryid,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        fields, objs = cPickle.loads(str(row[0]))
+        return SeSQLResultSet(objs, fields)
+
+    def set(self, queryid, results):
+        """
+        Store the result set for this queryid
+        """
+        data = cPickle.dumps((results.fields, list(results.objs)),
+                             cPickle.HIGHEST_PROTOCOL)
+        self.nb_set += 1
+        store_entry(self.TABLE_NAME, queryid, psycopg2.Binary(data),
+                    purge = self.nb_set % self.PURGE_EVERY == 0)
+
+@config.orm.transactional
+def store_entry(cursor, table, queryid, data, purge = False):
+    """
+    Store the data in the cache table, purging expired entries if asked to
+    """
+    if purge:
+        cursor.execute("DELETE FROM %s WHERE expires_at < NOW()" % table)
+    cursor.execute("DELETE FROM %s WHERE queryid = %%s" % table, (queryid,))
+    cursor.execute("""INSERT INTO %s (queryid, data, expires_at)
+                      VALUES (%%s, %%s, NOW() + %%s * interval '1 second')""" % table,
+                   (queryid, data, config.QUERY_CACHE_EXPIRY))
+
+BACKENDS = {
+    'local': LocalQueryCache,
+    'postgresql': PgQueryCache,
+}
+
+def get_query_cache():
+    """
+    Get an instance of the backend selected by QUERY_CACHE_BACKEND
+    """
+    name = getattr(config, 'QUERY_CACHE_BACKEND', 'local')
+    return BACKENDS[name]()
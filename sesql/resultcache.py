@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Cache of the short query results, invalidated by per-table write
+generations : each write to a table bumps its generation, and cached
+results computed with an older generation are discarded
+
+Generations are per-process, so writes done by other processes are
+only seen once the cached results expire (SHORTQUERY_CACHE_MAX_STALENESS)
+
+Tables are bumped when written to, and again once the transaction is
+committed, since results queried in between still see the old rows.
+Results on tables with uncommitted writes in any thread are not cached,
+since the commit may happen outside of SeSQL (managed transactions)
+"""
+import thread
+import threading
+
+from GenericCache import GenericCache
+
+from sesql import config
+
+
+class ResultCache(object):
+    """
+    Cache of result sets, with per-table generations
+    """
+    def __init__(self, maxsize = 1000, expiry = 60):
+        """
+        Constructor
+        """
+        self.cache = GenericCache(maxsize = maxsize, expiry = expiry)
+        self.generations = {}
+        self.lock = threading.Lock()
+        # Tables written to by the uncommitted transaction of each thread,
+        # by thread id
+        self.pending = {}
+
+    def bump(self, table):
+        """
+        Record a write to the table
+        """
+        self.lock.acquire()
+        try:
+            self.generations[table] = self.generations.get(table, 0) + 1
+        finally:
+            self.lock.release()
+
+    def write(self, table):
+        """
+        Record a write to the table, in the current transaction
+        """
+        self.bump(table)
+        self.lock.acquire()
+        try:
+            self.pending.setdefault(thread.get_ident(), set()).add(table)
+        finally:
+            self.lock.release()
+
+    def committed(self):
+        """
+        Record the commit of the current transaction
+        """
+        self.lock.acquire()
+        try:
+            tables = self.pending.pop(thread.get_ident(), ())
+        finally:
+            self.lock.release()
+        for table in tables:
+            self.bump(table)
+
+    def is_pending(self, tables):
+        """
+        Check if any of those tables has uncommitted writes
+        """
+        self.lock.acquire()
+        try:
+            for pending in self.pending.values():
+                if pending.intersection(tables):
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def get_generations(self, tables):
+        """
+        Get the current generations of those tables
+        """
+        return tuple([ self.generations.get(table, 0)
+                       for table in sorted(tables) ])
+
+    def get(self, key, tables):
+        """
+        Get the results stored for this key, None if not found or
+        outdated
+        """
+        entry = self.cache.fetch(key)
+        if entry is None:
+            return None
+        generations, results = entry
+        if generations != self.get_generations(tables):
+            self.cache.remove(key)
+            return None
+        return results
+
+    def set(self, key, generations, results):
+        """
+        Store results computed when the tables were at those generations
+        """
+        self.cache.insert(key, (generations, results))
+
+shortquery_cache = ResultCache(getattr(config, 'SHORTQUERY_CACHE_MAX_SIZE', 1000),
+                               getattr(config, 'SHORTQUERY_CACHE_MAX_STALENESS', 60))
+
+def bump(table):
+    """
+    Record a write to the table, in the current transaction
+    """
+    shortquery_cache.write(table)
+
+def committed():
+    """
+    Record the commit of the current transaction
+    """
+    shortquery_cache.committed()
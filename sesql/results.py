@@ -16,7 +16,10 @@
 
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+import sys
 import logging
+import itertools
+from array import array
 
 from sesql import config
 from sesql.typemap import typemap
@@ -24,6 +27,182 @@ from sesql.typemap import typemap
 log = logging.getLogger('sesql')
 
 
+class CompactRows(object):
+    """
+    Compact storage of result rows, behaving like a read-only list of
+    (classname, id, extra fields...) tuples
+    Class names are interned as codes in an array, ids are stored in an
+    array, and extra fields in one list per field
+    """
+    def __init__(self, rows = (), nbfields = 2):
+        """
+        Constructor
+        """
+        self.classnames = []
+        self.codes = {}
+        self.classes = array('H')
+        self.ids = array('l')
+        self.extra = [ [] for i in range(nbfields - 2) ]
+        for row in rows:
+            self.append(row)
+
+    def append(self, row):
+        """
+        Add a row at the end
+        """
+        classname = row[0]
+        code = self.codes.get(classname)
+        if code is None:
+            code = self.codes[classname] = len(self.classnames)
+            self.classnames.append(classname)
+        self.classes.append(code)
+        self.ids.append(row[1])
+        for column, value in zip(self.extra, row[2:]):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[i] for i in xrange(*index.indices(len(self))) ]
+        row = (self.classnames[self.classes[index]], self.ids[index])
+        if self.extra:
+            row += tuple([ column[index] for column in self.extra ])
+        return row
+
+    def __getslice__(self, i, j):
+        return self[slice(i, j)]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def nbytes(self):
+        """
+        Estimate the memory used by the rows, in bytes
+        """
+        size = len(self.classes) * self.classes.itemsize
+        size += len(self.ids) * self.ids.itemsize
+        size += sum([ sys.getsizeof(name) for name in self.classnames ])
+        for column in self.extra:
+            size += sys.getsizeof(column)
+            size += sum([ sys.getsizeof(value) for value in column ])
+        return size
+
+class Brain(object):
+    """
+    A row of the index, with the fetched fields as attributes
+    Also behaves as a read-only dictionnary
+    """
+    __slots__ = ()
+
+    def __init__(self, row):
+        """
+        Constructor
+        """
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError, name
+        return getattr(self, name)
+
+    def get(self, name, default = None):
+        """
+        Get a field value, or default
+        """
+        if name not in self.__slots__:
+            return default
+        return getattr(self, name)
+
+    def keys(self):
+        """
+        Get the names of the fields
+        """
+        return list(self.__slots__)
+
+    def items(self):
+        """
+        Get the (name, value) couples
+        """
+        return [ (name, getattr(self, name)) for name in self.__slots__ ]
+
+    def __contains__(self, name):
+        return name in self.__slots__
+
+    def __repr__(self):
+        return "<Brain %r>" % dict(self.items())
+
+_brain_classes = {}
+
+def get_brain_class(fields):
+    """
+    Get the Brain class with slots for those fields
+    """
+    fields = tuple(fields)
+    klass = _brain_classes.get(fields)
+    if klass is None:
+        klass = type("Brain", (Brain,), { "__slots__": fields })
+        _brain_classes[fields] = klass
+    return klass
+
+class StreamedRows(object):
+    """
+    The rows of a server-side cursor, behaving like a read-only list
+    Rows are fetched by batches when iterating, so only one batch is in
+    memory at a time ; indexing and slicing scroll the cursor
+    """
+    def __init__(self, cursor, count, batch_size):
+        """
+        Constructor
+        Count must be a callable giving the number of rows
+        """
+        self.cursor = cursor
+        self.count = count
+        self.batch_size = batch_size
+        self._len = None
+
+    def __len__(self):
+        if self._len is None:
+            self._len = self.count()
+        return self._len
+
+    def __iter__(self):
+        self.cursor.scroll(0, mode = 'absolute')
+        while True:
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0:
+            raise IndexError("index out of range")
+        self.cursor.scroll(index, mode = 'absolute')
+        row = self.cursor.fetchone()
+        if row is None:
+            raise IndexError("index out of range")
+        return row
+
+    def __getslice__(self, i, j):
+        if i < 0 or j < 0:
+            i, j, _ = slice(i, j).indices(len(self))
+        elif j - i > self.batch_size:
+            # Open-ended slices give sys.maxint as end
+            j = min(j, len(self))
+        if j <= i:
+            return []
+        self.cursor.scroll(i, mode = 'absolute')
+        return self.cursor.fetchmany(j - i)
+
 class SeSQLResultSet(object):
     """
     A lazy SeSQL result set
@@ -33,17 +212,29 @@ class SeSQLResultSet(object):
     def __init__(self, objs, fields):
         """
         Constructor
-        Objs must be a list of (class, id) with optionally extra fields
+        Objs must be a list of (class, id) with optionally extra fields,
+        or a StreamedRows ; lists are stored as CompactRows
         """
+        if isinstance(objs, list):
+            objs = CompactRows(objs, len(fields))
         self.objs = objs
         self.fields = fields
 
+    def nbytes(self):
+        """
+        Estimate the memory used by the results, in bytes
+        """
+        nbytes = getattr(self.objs, "nbytes", None)
+        return nbytes and nbytes() or 0
+
     def brains(self):
         """
-        Get the raw objects from SeSQL index, aka the "brains", as dictionnaries
+        Get the raw objects from SeSQL index, aka the "brains", as Brain
+        objects
         """
+        klass = get_brain_class(self.fields)
         for obj in self.objs:
-            yield dict(zip(self.fields, obj))
+            yield klass(obj)
 
     def count(self):
         """
@@ -54,13 +245,19 @@ class SeSQLResultSet(object):
 
     def iterator(self):
         """
-        Iterate on self
+        Iterate on self, loading the objects by batches
         """
-        for obj in self.objs:
-            try:
-                yield self.load(obj)
-            except config.orm.not_found:
-                log.warning("Object %r does not exist ! Broken index ?" % (obj,))
+        batch_size = getattr(config, 'LOAD_BATCH_SIZE', 50)
+        rows = iter(self.objs)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            for obj, item in zip(batch, self.load_many(batch)):
+                if item is None:
+                    log.warning("Object %r does not exist ! Broken index ?" % (obj,))
+                else:
+                    yield item
     __iter__ = iterator
 
     def all(self):
@@ -80,7 +277,11 @@ class SeSQLResultSet(object):
         """
         Get a slice
         """
-        res = [ self.load(obj) for obj in self.objs[i:j] ]
+        objs = self.objs[i:j]
+        res = self.load_many(objs)
+        for obj, item in zip(objs, res):
+            if item is None:
+                raise config.orm.not_found("Object %r does not exist" % (obj,))
         return res
 
     @staticmethod
@@ -96,6 +297,29 @@ class SeSQLResultSet(object):
         log.debug("Fetching %s" % entry)
         return config.orm.load_object(objclass, objid)
 
+    @staticmethod
+    def load_many(objs):
+        """
+        Get the objects of given rows, in the same order, with one query
+        per class ; missing objects are given as None
+        """
+        byclass = {}
+        for obj in objs:
+            byclass.setdefault(obj[0], []).append(obj[1])
+
+        loaded = {}
+        for classname, ids in byclass.items():
+            objclass = typemap.get_class_by_name(classname)
+            if not objclass:
+                found = dict([ (oid, config.orm.not_found) for oid in ids ])
+            else:
+                log.debug("Fetching %d %s" % (len(ids), objclass.__name__))
+                found = config.orm.load_objects(objclass, ids)
+            for oid, item in found.items():
+                loaded[(classname, oid)] = item
+
+        return [ loaded.get((obj[0], obj[1])) for obj in objs ]
+
     def historize(self, query):
         """save in the database the query for future processing"""
         nb_results = self.count()
@@ -16,8 +16,14 @@
 
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
-from sesql.utils import log_time
+from sesql import config
+from sesql.utils import log_time, SingleFlight
 from sesql.query import SeSQLQuery
+from sesql.typemap import typemap
+from sesql.resultcache import shortquery_cache
+
+# Concurrent identical short queries
+_flights = SingleFlight()
 
 @log_time
 def shortquery(query, order=None, limit=50, historize=False, fields = ()):
@@ -27,9 +33,38 @@ def shortquery(query, order=None, limit=50, historize=False, fields = ()):
     If fields are specified, will fetch those fields from the index
     """
     query = SeSQLQuery(query, order, fields)
-    results = query.shortquery(limit)
+    if getattr(config, 'SHORTQUERY_CACHE', False):
+        function = cached_shortquery
+    else:
+        function = SeSQLQuery.shortquery
+    if getattr(config, 'COALESCE_QUERIES', False):
+        results = _flights.do(query.get_cache_key(limit), function, query, limit)
+    else:
+        results = function(query, limit)
 
     if historize: #suggest feature hook
         results.historize(query)
 
     return results
+
+def cached_shortquery(query, limit):
+    """
+    Perform a short query, through the short query cache
+    """
+    table = query.get_table_name()
+    if table != config.MASTER_TABLE_NAME:
+        tables = [ table ]
+    else:
+        tables = query.get_tables().keys() or typemap.all_tables()
+
+    key = query.get_cache_key(limit)
+    results = shortquery_cache.get(key, tables)
+    if results is None:
+        # Generations must be taken before querying, so that a write
+        # during the query discards the results
+        generations = shortquery_cache.get_generations(tables)
+        results = query.shortquery(limit)
+        # They may not be those seen once the pending writes are committed
+        if not shortquery_cache.is_pending(tables):
+            shortquery_cache.set(key, generations, results)
+    return results
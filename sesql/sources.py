@@ -19,6 +19,9 @@
 """
 Contain the various kind of field aggregators/fetchers/...
 """
+import threading
+
+_memo = threading.local()
 
 
 # Automatic dispatcher
@@ -47,6 +50,86 @@ def guess_source(what):
         return MethodCaller(what[:-2])
     return SimpleField(what)
 
+# Memoization
+
+class SourceMemo(object):
+    """
+    Cache the data loaded by sources for a given object, during one
+    indexing pass - to be used with a "with" statement
+    """
+    def __init__(self, obj):
+        """
+        Constructor
+        """
+        self.obj = obj
+        self.values = {}
+        self.previous = None
+
+        # Start with the data prefetched for this object, if any
+        prefetch = getattr(_memo, 'prefetch', None)
+        if prefetch is not None:
+            self.values.update(prefetch.values.get(id(obj), {}))
+
+    def __enter__(self):
+        self.previous = getattr(_memo, 'current', None)
+        _memo.current = self
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _memo.current = self.previous
+
+class SourcePrefetch(object):
+    """
+    Prefetch the related objects of the SubField sources for a batch of
+    objects, with one query per relation - to be used with a "with"
+    statement, around the SourceMemo of each object
+    """
+    def __init__(self, objs, sources):
+        """
+        Constructor
+        """
+        self.values = {}
+        self.previous = None
+        if not objs:
+            return
+        done = set()
+        for source in sources:
+            for sub in iter_sources(source):
+                if isinstance(sub, SubField) and not sub.related_key() in done:
+                    done.add(sub.related_key())
+                    sub.prefetch(objs, self.values)
+
+    def __enter__(self):
+        self.previous = getattr(_memo, 'prefetch', None)
+        _memo.prefetch = self
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _memo.prefetch = self.previous
+
+def iter_sources(source):
+    """
+    Iterate over the source and all the sources it uses on the same object
+    """
+    yield source
+    for child in source.children():
+        for sub in iter_sources(child):
+            yield sub
+
+def memoize(key, obj, loader):
+    """
+    Load data for the object with loader, unless a memo is active for
+    this object and already contains this key
+    """
+    memo = getattr(_memo, 'current', None)
+    if key is None or memo is None or memo.obj is not obj:
+        return loader(obj)
+    try:
+        return memo.values[key]
+    except KeyError:
+        value = memo.values[key] = loader(obj)
+        return value
+
 # Main classes
 
 class AbstractSource(object):
@@ -59,6 +142,20 @@ class AbstractSource(object):
         """
         raise NotImplementedError
 
+    def memo_key(self):
+        """
+        Key identifying the data loaded by this source, so equivalent
+        sources are only evaluated once per object ; None if the data
+        can't be memoized
+        """
+        return None
+
+    def children(self):
+        """
+        Get the sources used by this one on the same object
+        """
+        return []
+
     def __call__(self, obj):
         return self.load_data(obj)
 
@@ -96,7 +193,19 @@ class SimpleField(AbstractSource):
         """
         self.name = name
 
+    def memo_key(self):
+        """
+        Sources of the same kind on the same name load the same data
+        """
+        return (self.__class__.__name__, self.name)
+
     def load_data(self, obj):
+        """
+        Get the data, from the memo if possible
+        """
+        return memoize(self.memo_key(), obj, self.fetch)
+
+    def fetch(self, obj):
         """
         Get the data directly
         """
@@ -110,7 +219,7 @@ class MethodCaller(SimpleField):
     """
     What we index is the result of a method
     """
-    def load_data(self, obj):
+    def fetch(self, obj):
         """
         Call the method, if it is callable
         """
@@ -132,9 +241,48 @@ class SubField(AbstractSource):
         self.getter = guess_source(getter)
         self.condition = condition
 
-    def load_data(self, obj):
+    def children(self):
         """
-        Get the data from the sub-object(s)
+        Get the sources used by this one on the same object
+        """
+        return [ self.child ]
+
+    def prefetch(self, objs, values):
+        """
+        Prefetch the related objects for all those objects at once, and
+        store them in values, as { id(obj): { related_key: data } }
+        Only relations given by name can be prefetched
+        """
+        from sesql import config
+
+        key = self.related_key()
+        if key is None or self.child.__class__ is not SimpleField:
+            return
+
+        byclass = {}
+        for obj in objs:
+            byclass.setdefault(obj.__class__, []).append(obj)
+
+        for items in byclass.values():
+            related = config.orm.prefetch_related(items, self.child.name,
+                                                  self.condition)
+            if related is None:
+                continue
+            for obj, what in zip(items, related):
+                values.setdefault(id(obj), {})[key] = (True, what)
+
+    def related_key(self):
+        """
+        Key identifying the related object(s) in the memo
+        """
+        key = self.child.memo_key()
+        if key is None:
+            return None
+        return ('related',) + key + (repr(self.condition),)
+
+    def load_related(self, obj):
+        """
+        Get the related object(s), as a (many, what) tuple
         """
         what = self.child.load_data(obj)
 
@@ -146,7 +294,16 @@ class SubField(AbstractSource):
                 what = what.all()
             except Exception, e:
                 what = []
+            return True, list(what)
+        return False, what
+
+    def load_data(self, obj):
+        """
+        Get the data from the sub-object(s)
+        """
+        many, what = memoize(self.related_key(), obj, self.load_related)
 
+        if many:
             res = []
             for w in what:
                 data = self.getter(w)
@@ -171,6 +328,12 @@ class TextAggregate(AbstractSource):
         """
         self.sources = [ guess_source(s) for s in sources ]
 
+    def children(self):
+        """
+        Get the sources used by this one on the same object
+        """
+        return self.sources
+
     def load_data(self, obj):
         """
         Get the data directly
@@ -207,6 +370,12 @@ class WeightedAggregate(TextAggregate):
         self.sources = dict([ (k, guess_source(v)) for k,v in sources.items() ])
         self.weights = self.sources.keys()
 
+    def children(self):
+        """
+        Get the sources used by this one on the same object
+        """
+        return self.sources.values()
+
     def load_data(self, obj, weight = None):
         """
         Get the data directly but limiting to given weight if given
@@ -230,6 +399,12 @@ class FirstOf(AbstractSource):
         """
         self.sources = [ guess_source(s) for s in sources ]
 
+    def children(self):
+        """
+        Get the sources used by this one on the same object
+        """
+        return self.sources
+
     def load_data(self, obj):
         """
         Get the data directly
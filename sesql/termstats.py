@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Pilot Systems and Libération, 2010-2013
+
+# This file is part of SeSQL.
+
+# SeSQL is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+
+# SeSQL is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Term statistics : for each table and full text field, the number of
+rows containing each word, computed by ts_stat and stored in the
+sesql_term_stats table, to estimate the selectivity of full text
+queries
+"""
+import logging
+
+from GenericCache import GenericCache
+
+from sesql import config
+
+log = logging.getLogger('sesql')
+
+TABLE_NAME = "sesql_term_stats"
+
+# Word under which the number of rows of the table is stored
+TOTAL = ''
+
+_cache = GenericCache(maxsize = getattr(config, 'TERM_STATS_CACHE_SIZE', 50000),
+                      expiry = getattr(config, 'TERM_STATS_CACHE_EXPIRY', 3600))
+
+@config.orm.transactional
+def refresh(cursor, table, field, sample = None):
+    """
+    Refresh the statistics of a full text field on a table
+    If sample (a percentage) is given, they are computed on a sample
+    of the rows only, and scaled
+    """
+    source = table
+    scale = 1.0
+    if sample:
+        source = "%s TABLESAMPLE SYSTEM (%f)" % (table, sample)
+        scale = 100.0 / sample
+
+    min_ndoc = getattr(config, 'TERM_STATS_MIN_NDOC', 1)
+    cursor.execute("DELETE FROM %s WHERE tablename = %%s AND field = %%s" % TABLE_NAME,
+                   (table, field.name))
+    cursor.execute("""INSERT INTO %s (tablename, field, word, ndoc)
+SELECT %%s, %%s, word, round(ndoc * %f)
+FROM ts_stat('SELECT %s FROM %s')
+WHERE ndoc >= %%s""" % (TABLE_NAME, scale, field.index_column, source),
+                   (table, field.name, min_ndoc))
+    cursor.execute("""INSERT INTO %s (tablename, field, word, ndoc)
+SELECT %%s, %%s, %%s, round(count(*) * %f)
+FROM %s""" % (TABLE_NAME, scale, source), (table, field.name, TOTAL))
+
+def get_lexemes(field, value):
+    """
+    Get the lexemes of a text, as they are indexed in the field
+    """
+    cursor = config.orm.cursor()
+    cursor.execute("SELECT tsvector_to_array(to_tsvector('%s', %%s))" % field.dictionnary,
+                   (field.marshall(value),))
+    return cursor.fetchone()[0] or []
+
+def _fetch(table, field, words):
+    """
+    Get the number of rows of the table containing each of the words
+    in the field (0 if unknown)
+    """
+    missing = [ word for word in words
+                if _cache.fetch((table, field.name, word)) is None ]
+    if missing:
+        cursor = config.orm.cursor()
+        cursor.execute("""SELECT word, ndoc FROM %s
+WHERE tablename = %%s AND field = %%s AND word IN (%s)""" % (TABLE_NAME,
+                                                            ','.join([ "%s" ] * len(missing))),
+                       [ table, field.name ] + missing)
+        found = dict(cursor.fetchall())
+        for word in missing:
+            _cache.insert((table, field.name, word), found.get(word, 0))
+    return dict([ (word, _cache.fetch((table, field.name, word)) or 0)
+                  for word in words ])
+
+def get_total(table, field):
+    """
+    Get the number of rows of the table, as of the last refresh
+    """
+    return _fetch(table, field, [ TOTAL ])[TOTAL]
+
+def get_frequencies(table, field, words):
+    """
+    Get the fraction of the rows of the table containing each of the
+    words in the field ; None if there are no statistics
+    Words missing from the statistics (too rare in the sample, or new)
+    have a None fraction, since it can't be told how rare they are
+    """
+    total = get_total(table, field)
+    if not total:
+        return None
+    ndocs = _fetch(table, field, words)
+    return dict([ (word, ndoc and float(ndoc) / total or None)
+                  for word, ndoc in ndocs.items() ])
@@ -17,8 +17,11 @@
 # You should have received a copy of the GNU General Public License
 # along with SeSQL.  If not, see <http://www.gnu.org/licenses/>.
 
+import sys
 import time
 import logging
+import threading
+import unicodedata
 log = logging.getLogger('sesql')
 
 
@@ -59,6 +62,54 @@ class Timer(object):
         self.reset()
         return res
 
+class SingleFlight(object):
+    """
+    Coalesce identical concurrent calls : while a call for a given key
+    is running, other callers with the same key wait for it, and share
+    its result (or its exception)
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Call function, unless a call with the same key is running
+        """
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = { "event": threading.Event() }
+        finally:
+            self.lock.release()
+
+        if not leader:
+            call["event"].wait()
+            if "error" in call:
+                error = call["error"]
+                raise error[0], error[1], error[2]
+            return call["result"]
+
+        try:
+            try:
+                call["result"] = function(*args, **kwargs)
+            except:
+                call["error"] = sys.exc_info()
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call["event"].set()
+        return call["result"]
+
 def safe_str(what):
     """
     Gives a safe string form of what, never failing
@@ -94,40 +145,74 @@ def log_time(function, message = None):
     return log_time_inner
 
                  
+LIGATURES = {
+    u'\N{Latin capital letter AE}': 'AE',
+    u'\N{Latin small letter ae}': 'ae',
+    u'\N{Latin capital letter Eth}': 'Dh',
+    u'\N{Latin small letter eth}': 'dh',
+    u'\N{Latin capital letter O with stroke}': 'Oe',
+    u'\N{Latin small letter o with stroke}': 'oe',
+    u'\N{Latin capital letter Thorn}': 'Th',
+    u'\N{Latin small letter thorn}': 'th',
+    u'\N{Latin small letter sharp s}': 'ss',
+    u'\N{Latin capital letter D with stroke}': 'Dj',
+    u'\N{Latin small letter d with stroke}': 'dj',
+    u'\N{Latin capital letter H with stroke}': 'H',
+    u'\N{Latin small letter h with stroke}': 'h',
+    u'\N{Latin small letter dotless i}': 'i',
+    u'\N{Latin small letter kra}': 'q',
+    u'\N{Latin capital letter L with stroke}': 'L',
+    u'\N{Latin small letter l with stroke}': 'l',
+    u'\N{Latin capital letter Eng}': 'Ng',
+    u'\N{Latin small letter eng}': 'ng',
+    u'\N{Latin capital ligature OE}': 'Oe',
+    u'\N{Latin small ligature oe}': 'oe',
+    u'\N{Latin capital letter T with stroke}': 'Th',
+    u'\N{Latin small letter t with stroke}': 'th',
+}
+
 def strip_ligatures(value):
     """
     Convert the ligatures (œ, æ, ß, ...) into their compound value (oe, ae, ss)
     Take **unicode** as input and output, not string
     """
-    charmap = {
-        u'\N{Latin capital letter AE}': 'AE',
-        u'\N{Latin small letter ae}': 'ae',
-        u'\N{Latin capital letter Eth}': 'Dh',
-        u'\N{Latin small letter eth}': 'dh',
-        u'\N{Latin capital letter O with stroke}': 'Oe',
-        u'\N{Latin small letter o with stroke}': 'oe',
-        u'\N{Latin capital letter Thorn}': 'Th',
-        u'\N{Latin small letter thorn}': 'th',
-        u'\N{Latin small letter sharp s}': 'ss',
-        u'\N{Latin capital letter D with stroke}': 'Dj',
-        u'\N{Latin small letter d with stroke}': 'dj',
-        u'\N{Latin capital letter H with stroke}': 'H',
-        u'\N{Latin small letter h with stroke}': 'h',
-        u'\N{Latin small letter dotless i}': 'i',
-        u'\N{Latin small letter kra}': 'q',
-        u'\N{Latin capital letter L with stroke}': 'L',
-        u'\N{Latin small letter l with stroke}': 'l',
-        u'\N{Latin capital letter Eng}': 'Ng',
-        u'\N{Latin small letter eng}': 'ng',
-        u'\N{Latin capital ligature OE}': 'Oe',
-        u'\N{Latin small ligature oe}': 'oe',
-        u'\N{Latin capital letter T with stroke}': 'Th',
-        u'\N{Latin small letter t with stroke}': 'th',
-    }
-
-    value = ''.join([ charmap.get(c,c) for c in value ])    
+    value = ''.join([ LIGATURES.get(c,c) for c in value ])
     return value
 
+class NormalizeTable(dict):
+    """
+    Translation table for unicode.translate, doing in a single pass the
+    ligature folding, the replacement of non-letters by spaces, the
+    accent stripping and the lowercasing
+    It is filled lazily, each codepoint being computed on first use
+    """
+    def __init__(self, extra_letters = ""):
+        self.extra_letters = extra_letters
+
+    def __missing__(self, code):
+        char = unichr(code)
+        if char in LIGATURES:
+            value = LIGATURES[char]
+        elif unicodedata.category(char)[0] in ('L', 'N') or char in self.extra_letters:
+            value = char
+        else:
+            value = u' '
+        value = unicodedata.normalize('NFKD', unicode(value))
+        value = unicode(value.encode('ascii', 'ignore').lower())
+        self[code] = value
+        return value
+
+_normalize_tables = {}
+
+def get_normalize_table(extra_letters = ""):
+    """
+    Get the translation table for those extra letters, building it once
+    """
+    table = _normalize_tables.get(extra_letters)
+    if table is None:
+        table = _normalize_tables[extra_letters] = NormalizeTable(extra_letters)
+    return table
+
 def format_time(timedelta, keep = 3):
     """
     Pretty format a timedelta